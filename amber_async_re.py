@@ -2,7 +2,7 @@ import os
 
 import amberio.ambertools as at
 from amberio.amberrun import read_amber_groupfile, amberrun_from_files
-from pj_async_re import async_re_job, _exit
+from pj_async_re import async_re_job, _exit, _split_keyword
 
 __all__ = ['pj_amber_job', 'amber_states_from_configobj',
            'extract_amber_coordinates', 'SUPPORTED_AMBER_ENGINES',
@@ -42,21 +42,45 @@ class pj_amber_job(async_re_job):
             _exit('Requested ENGINE (%s) is either invalid or not '
                   'currently supported.'%self.keywords.get('ENGINE'))
 
-        if int(self.keywords.get('SUBJOB_CORES')) > 1:
+        self.states = amber_states_from_configobj(self.keywords,self.verbose)
+        self.nreplicas = len(self.states)
+
+        # Replicas in states using more than one core run the MPI executable,
+        # the others run the serial one.
+        cores = [self._stateCores(sid) for sid in range(self.nreplicas)]
+        if max(cores) > 1:
             self.spmd = 'mpi'
-            engine = '%s.MPI'%engine
             if not at.AMBER_MPI_EXES:
                 _exit('Cannot find AMBER MPI executables. Are these compiled '
                       'and in AMBERHOME/bin?')
         else:
             self.spmd = 'single'
+        if min(cores) == 1:
             if not at.AMBER_SERIAL_EXES:
                 _exit('Cannot find AMBER serial executables. Are these '
                       'compiled and in AMBERHOME/bin?')
-      
+
         self.exe = os.path.join(at.AMBERHOME,'bin',engine)
-        self.states = amber_states_from_configobj(self.keywords,self.verbose)
-        self.nreplicas = len(self.states)
+        self.exe_mpi = os.path.join(at.AMBERHOME,'bin','%s.MPI'%engine)
+
+    def _autotuneTrials(self):
+        """
+        Add the choice of AMBER engine (AUTOTUNE_ENGINES, e.g. 'SANDER,PMEMD')
+        to the calibrated launch configurations.
+        """
+        trials = async_re_job._autotuneTrials(self)
+        if self.keywords.get('AUTOTUNE_ENGINES') is None:
+            return trials
+        engine_trials = []
+        for engine in _split_keyword(self.keywords.get('AUTOTUNE_ENGINES')):
+            if not SUPPORTED_AMBER_ENGINES.has_key(engine.strip().upper()):
+                _exit('Requested AUTOTUNE_ENGINES (%s) is either invalid or '
+                      'not currently supported.'%engine)
+            for trial in trials:
+                engine_trial = dict(trial)
+                engine_trial['ENGINE'] = engine.strip().upper()
+                engine_trials.append(engine_trial)
+        return engine_trials
 
     def _buildInpFile(self, repl, state = None):
         """
@@ -118,13 +142,21 @@ class pj_amber_job(async_re_job):
         amber_env = ['AMBERHOME=%s'%at.AMBERHOME, 'MKL_HOME=%s'%at.MKL_HOME]
         amber_env.extend(self.engine_environment)
 
+        # Number of cores for the current state of this replica
+        ncores = self._replicaCores(repl)
+        if ncores > 1:
+            exe = self.exe_mpi
+        else:
+            exe = self.exe
+
         script_name = 'run'
         run_script = open('%s/%s'%(wdir,script_name),'w')
         for env in amber_env:
             run_script.write('export %s\n'%env)
-        run_script.write('EXE=%s\n\n'%self.exe)
+        run_script.write('EXE=%s\n\n'%exe)
         run_script.write('cd %s\n'%wdir)
-        run_script.write('$EXE %s\n\n'%(' '.join(args)))
+        run_script.write(self._affinityScript(ncores))
+        run_script.write('$PIN $EXE %s\n\n'%(' '.join(args)))
         # run_script.write('cd ..\n')
         # run_script.write('python calc_all_us_state_energies.py %s %s %d\n'
         #                  %(self.command_file,'%s/%s'%(wdir,restrt),repl))
@@ -139,11 +171,11 @@ class pj_amber_job(async_re_job):
             'output': stdout,
             'error': stderr,   
             'working_directory': wdir,
-            'number_of_processes': int(self.keywords.get('SUBJOB_CORES')),
+            'number_of_processes': ncores,
             'spmd_variation': 'single',
             }
 
-        compute_unit = self.pilotcompute.submit_compute_unit(cpt_unit_desc)
+        compute_unit = self._submitComputeUnit(repl,cpt_unit_desc)
         return compute_unit
         
     def _hasCompleted(self, repl, cyc):
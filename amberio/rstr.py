@@ -14,12 +14,16 @@ from math import pi
 from itertools import permutations
 import re
 
+from numpy import (array, where, sort, arange, concatenate, unique, floor,
+                   ceil, sqrt)
+
 import coordinates
 from namelist import read_namelists
 
 __author__ = 'Brian K. Radak (BKR) - <radakb@biomaps.rutgers.edu>'
 
-__all__ = ['read_amber_restraint','AmberRestraint','NmroptRestraint']
+__all__ = ['read_amber_restraint','AmberRestraint','NmroptRestraint',
+           'RestraintTable']
 
 
 def read_amber_restraint(rst_name):
@@ -791,6 +795,144 @@ class GenDistCoordRestraint(NmroptRestraint):
                 drdx[3*j+m] += self.rstwt[k]*drdxj[m]
         return r,drdx
 
+
+class RestraintTable(object):
+    """
+    Energies of the same restraint coordinates in many states at once.
+
+    States that differ only by their restraint parameters share the restraint
+    coordinates of a set of atomic coordinates. These are computed once and 
+    the energies in all of the states are then obtained with array operations
+    over a states x restraints table of positions and force constants. Each 
+    torsion is taken at its periodic image nearest to the center of the well 
+    of each state, as in TorsionRestraint.coord().
+
+    REQUIRED ARGUMENTS:
+    restraints - list of AmberRestraints, one per state, with the same 
+                 restraint definitions in the same order
+    """
+    def __init__(self, restraints):
+        reference = restraints[0]
+        for rstr in restraints[1:]:
+            same = len(rstr) == len(reference)
+            for rst,ref in zip(rstr,reference):
+                same = (same and type(rst) == type(ref) 
+                        and tuple(rst.iat) == tuple(ref.iat)
+                        and getattr(rst,'rstwt',None) == getattr(ref,'rstwt',
+                                                                 None))
+            if not same:
+                raise ValueError('The restraints of all states must be'
+                                 ' defined on the same coordinates.')
+        self.restraints = reference
+        # positions (r2 and the center of the well) and force constants, as
+        # in NmroptRestraint.energy_and_gradients()
+        self.r0 = array([[rst._r[1] for rst in rstr] for rstr in restraints])
+        self.rmean = array([[(rst._r[1] + rst._r[2])/2. for rst in rstr]
+                            for rstr in restraints])
+        self.k0 = array([[rst._rk[0] for rst in rstr] for rstr in restraints])
+        self.periodic = array([isinstance(rst,TorsionRestraint)
+                               for rst in reference],dtype=bool)
+        self.report_conversion = array([rst._report_conversion
+                                        for rst in reference])
+        # positions of the states sorted along each restraint, their order
+        # and the smallest force constants, to look up the states near a
+        # set of coordinates (see coord_energies_within())
+        self._order = self.r0.argsort(axis=0)
+        self._sorted = sort(self.r0,axis=0)
+        self._kmin = self.k0.min(axis=0)
+
+    def coords(self, crds):
+        """
+        Return the array of restraint coordinates given a 3N coordinate list
+        (torsions are NOT shifted to any periodic image).
+        """
+        r = []
+        for rst in self.restraints:
+            if isinstance(rst,TorsionRestraint):
+                i,j,k,l = [n - 1 for n in rst.iat]
+                r.append(coordinates.Dihedral(crds,i,j,k,l))
+            else:
+                r.append(rst.coord(crds))
+        return array(r,dtype=float)
+
+    def report_coords(self, values):
+        """
+        Return the array of restraint coordinates given their values in the
+        units of AMBER reports (Angstroms and degrees), such as a record of
+        a DUMPAVE file.
+        """
+        return array(values,dtype=float)/self.report_conversion
+
+    def energies(self, crds, states=None):
+        """
+        Calculate the total restraint energy in each state.
+
+        REQUIRED ARGUMENTS:
+        crds - 3N list of coordinates (in Angstroms)
+
+        OPTIONAL ARGUMENTS:
+        states - indices of the states, default=all of them
+
+        RETURN VALUES:
+        energies - array of the restraint energies (in kcal/mol)
+        """
+        return self.coord_energies(self.coords(crds),states)
+
+    def coord_energies(self, r, states=None):
+        """
+        Calculate the total restraint energy in each state given the array
+        of restraint coordinates (see coords() and report_coords()).
+        """
+        r0,rmean,k0 = self.r0,self.rmean,self.k0
+        if states is not None:
+            r0,rmean,k0 = r0[states],rmean[states],k0[states]
+        dr = r - r0
+        # periodic image of the torsions nearest to the center of each well
+        image = (r - rmean + pi) % (2*pi) - pi + rmean
+        dr = where(self.periodic,image - r0,dr)
+        return (k0*dr**2).sum(axis=1)
+
+    def coord_energies_within(self, r, energy):
+        """
+        Return the indices of the states in which the restraint energy of
+        the restraint coordinates r is at most energy, in increasing order,
+        and the energies in those states, without computing the energies in
+        the other states. A state can only qualify if, along each restraint,
+        its position is within sqrt(energy/kmin) of r (or of a periodic
+        image of r), kmin being the smallest force constant of the
+        restraint. The candidates are looked up in the positions sorted along
+        the restraint which leaves the fewest of them.
+        """
+        candidates = None
+        for k in range(len(self.restraints)):
+            if self._kmin[k] <= 0.:
+                continue
+            h = sqrt(energy/self._kmin[k])
+            positions = self._sorted[:,k]
+            if self.periodic[k]:
+                if h >= pi:
+                    continue
+                # images of r within reach of the positions
+                shifts = arange(floor((positions[0] - r[k] - h)/(2*pi)),
+                                ceil((positions[-1] - r[k] + h)/(2*pi)) + 1)
+                shifts = shifts*2*pi
+            else:
+                shifts = [0.]
+            ranges = [(positions.searchsorted(r[k] + shift - h,'left'),
+                       positions.searchsorted(r[k] + shift + h,'right'))
+                      for shift in shifts]
+            count = sum([last - first for first,last in ranges])
+            if candidates is None or count < len(candidates):
+                candidates = concatenate([self._order[first:last,k]
+                                          for first,last in ranges])
+        if candidates is None:
+            states = arange(len(self.r0))
+        else:
+            states = unique(candidates)
+        u = self.coord_energies(r,states)
+        within = u <= energy
+        return states[within],u[within]
+
 if __name__ == '__main__':
     import sys
     import copy
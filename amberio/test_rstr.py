@@ -0,0 +1,89 @@
+"""Tests of the restraint energies of many states at once"""
+import unittest
+from copy import deepcopy
+
+from numpy import allclose, nonzero, array
+from numpy.random import RandomState
+
+from amberio.rstr import (AmberRestraint, RestraintTable, BondRestraint,
+                          AngleRestraint, TorsionRestraint)
+
+def _umbrellas(nstates=8):
+    # a bond, an angle and a torsion, the torsion wells all around the
+    # circle (in the units of AMBER input: Angstroms and degrees)
+    base = AmberRestraint([BondRestraint((1,2)),AngleRestraint((1,2,3)),
+                           TorsionRestraint((1,2,3,4))])
+    states = []
+    for s in range(nstates):
+        rstr = deepcopy(base)
+        rstr.set_restraint_params(r0=[1. + 0.1*s,60. + 10.*s,-180. + 45.*s],
+                                  k0=[5. + s,3.,2. + 0.5*s])
+        states.append(rstr)
+    return states
+
+class RestraintTableTest(unittest.TestCase):
+    def setUp(self):
+        self.states = _umbrellas()
+        self.table = RestraintTable(self.states)
+        rng = RandomState(0)
+        self.crds = [list(2.*rng.randn(12)) for k in range(5)]
+
+    def test_energies_of_all_states(self):
+        for crds in self.crds:
+            expected = [rstr.energy(crds) for rstr in self.states]
+            self.assertTrue(allclose(self.table.energies(crds),expected))
+
+    def test_energies_of_some_states(self):
+        states = [6,1,3]
+        for crds in self.crds:
+            expected = [self.states[s].energy(crds) for s in states]
+            self.assertTrue(allclose(self.table.energies(crds,states),
+                                     expected))
+
+    def test_report_coords(self):
+        # a DUMPAVE record holds the coordinates in Angstroms and degrees
+        for crds in self.crds:
+            r = self.table.coords(crds)
+            values = r*self.table.report_conversion
+            self.assertTrue(allclose(self.table.report_coords(values),r))
+            self.assertTrue(allclose(
+                self.table.coord_energies(self.table.report_coords(values)),
+                [rstr.energy(crds) for rstr in self.states]))
+
+    def test_energies_within(self):
+        # the same states and energies as computing them all
+        for crds in self.crds:
+            r = self.table.coords(crds)
+            u = self.table.coord_energies(r)
+            for energy in [0.,1.e6] + sorted(u) + list(u[:-1] + 0.5):
+                states,energies = self.table.coord_energies_within(r,energy)
+                within = nonzero(u <= energy)[0]
+                self.assertEqual(states.tolist(),within.tolist())
+                self.assertTrue(allclose(energies,u[within]))
+
+    def test_energies_within_look_up_nearby_states(self):
+        # 100 umbrellas 0.1 A apart: energies up to 1 kcal/mol are within
+        # sqrt(1/k0) = 0.32 A, and only the states nearby are computed
+        base = AmberRestraint([BondRestraint((1,2))])
+        states = []
+        for s in range(100):
+            rstr = deepcopy(base)
+            rstr.set_restraint_params(r0=[1. + 0.1*s],k0=[10.])
+            states.append(rstr)
+        table = RestraintTable(states)
+        computed = []
+        coord_energies = table.coord_energies
+        def counted(r, states=None):
+            computed.append(len(states))
+            return coord_energies(r,states)
+        table.coord_energies = counted
+        states,energies = table.coord_energies_within(array([5.03]),1.)
+        self.assertEqual(states.tolist(),range(38,44))
+        self.assertTrue(computed[0] <= 8)
+
+    def test_different_restraints_are_rejected(self):
+        states = self.states + [AmberRestraint([BondRestraint((1,3))])]
+        self.assertRaises(ValueError,RestraintTable,states)
+
+if __name__ == '__main__':
+    unittest.main()
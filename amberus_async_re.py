@@ -1,12 +1,13 @@
 import os
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 
-from configobj import ConfigObj
-from numpy import zeros, asarray
+from numpy import frombuffer, asarray, empty, nan, isnan, ix_
 
 import amberio.ambertools as at
-from amber_async_re import pj_amber_job, amber_states_from_configobj, \
-    extract_amber_coordinates, DISANG_NAME, DUMPAVE_EXT, _exit
+from amberio.rstr import RestraintTable
+from amber_async_re import pj_amber_job, extract_amber_coordinates, \
+    DISANG_NAME, DUMPAVE_EXT, _exit
 
 def _parse_state_params(paramline, state_delimiter=':'):
     """
@@ -103,6 +104,75 @@ def setup_us_states_from_configobj(states, keywords, verbose=False):
         state.mdin.nmr_vars['DISANG'] = DISANG_NAME
         state.rstr.set_restraint_params(r0=bias_positions[n],
                                         k0=force_constants[n])
+    return bias_positions
+
+def read_trace_record(replica, cycle, basename):
+    """
+    Return the last record of the restraint trace (DUMPAVE) file of a replica
+    at the end of a cycle, as the MD step and the list of the values of the
+    restraint coordinates (in Angstroms and degrees), or None if the file is 
+    missing or its last record cannot be read. Only the end of the file is 
+    read.
+    """
+    trace = 'r%d/%s_%d.%s'%(replica,basename,cycle,DUMPAVE_EXT)
+    try:
+        f = open(trace,'rb')
+    except IOError:
+        return None
+    try:
+        f.seek(0,2)
+        size = f.tell()
+        block = 1024
+        while True:
+            f.seek(max(size - block,0))
+            records = [line for line in f.read().split('\n') if line.strip()]
+            # (the first line read may be cut, unless it is the first one)
+            if len(records) > 1 or block >= size:
+                break
+            block *= 2
+    finally:
+        f.close()
+    if len(records) == 0:
+        return None
+    try:
+        values = [float(value) for value in records[-1].split()]
+    except ValueError:
+        return None
+    if len(values) < 2:
+        return None
+    return values[0],values[1:]
+
+def restraint_coordinates(table, replica, cycle, basename, nstlim):
+    """
+    Return the restraint coordinates of a replica at the end of a cycle
+    (see RestraintTable) from the last record of its restraint trace file
+    or, if the trace is missing or stale (not written at the last step of
+    the cycle, nstlim), from its restart coordinates.
+    """
+    record = read_trace_record(replica,cycle,basename)
+    if (record is not None and nstlim is not None and record[0] == nstlim
+        and len(record[1]) == len(table.restraints)):
+        return table.report_coords(record[1])
+    crds = extract_amber_coordinates(replica,cycle,basename)
+    return table.coords(crds)
+
+def bias_energies(table, beta, r, cutoff=None):
+    """
+    Return the reduced bias energies of restraint coordinates r in all of the
+    states. With a cutoff, they are only computed in the states whose biases
+    are centered within cutoff standard deviations of r (reduced energies up
+    to cutoff**2/2, see RestraintTable.coord_energies_within()), the others
+    being NaN (not computed, see ExchangeSampler). This depends on r only,
+    not on the state of the replica, so that a swap and its reverse need the
+    same energies.
+    """
+    if cutoff is None:
+        return beta*table.coord_energies(r)
+    u = empty(len(table.r0))
+    u.fill(nan)
+    states,energies = table.coord_energies_within(r,0.5*cutoff**2/beta)
+    u[states] = beta*energies
+    return u
 
 class amberus_async_re_job(pj_amber_job):
 
@@ -119,7 +189,89 @@ class amberus_async_re_job(pj_amber_job):
 
         # Umbrella sampling state information.
         #
-        setup_us_states_from_configobj(self.states,self.keywords,self.verbose)
+        self.bias_positions = setup_us_states_from_configobj(self.states,
+                                                             self.keywords,
+                                                             self.verbose)
+        # restraint parameters of all of the states, to get the energies of
+        # a replica in all of them at once
+        self.restraint_table = RestraintTable([state.rstr
+                                               for state in self.states])
+        # MD steps of a cycle, the step of the last record of the restraint
+        # trace files (None if it differs between states, in which case the
+        # restart coordinates are read instead)
+        nstlim = self.states.state_params_are_same('cntrl','nstlim')
+        if nstlim:
+            self.trace_nstlim = float(nstlim)
+        else:
+            self.trace_nstlim = None
+        # standard deviations of the biases beyond which swaps are not
+        # computed (see bias_energies())
+        if self.keywords.get('BIAS_CUTOFF') is not None:
+            self.bias_cutoff = float(self.keywords.get('BIAS_CUTOFF'))
+            if self.bias_cutoff <= 0.:
+                _exit('BIAS_CUTOFF must be positive')
+        else:
+            self.bias_cutoff = None
+        # restraint coordinates of the replicas, by replica: (cycle, coords)
+        self.exchange_crds = {}
+        # processes computing the swap matrix (see setupJob()) and the
+        # shared memory of _energyMatrix() they write into
+        self.energy_pool = None
+        self.shared_energies = None
+
+    def _startPools(self):
+        """
+        Start the processes computing the swap matrix, which keep the 
+        restraint parameters of the states for the whole run and also sample
+        the blocks of large exchanges (see async_re_job._startPools()).
+        """
+        if not self.autotune_mode:
+            self._startEnergyPool()
+            self.exchange_pool = self.energy_pool
+
+    def finalizeJob(self):
+        if self.exchange_pool is self.energy_pool:
+            self.exchange_pool = None
+        pj_amber_job.finalizeJob(self)
+        if self.energy_pool is not None:
+            self.energy_pool.close()
+            self.energy_pool.join()
+            self.energy_pool = None
+
+    def _warmUp(self):
+        """
+        Start the processes computing the swap matrix, if not done yet, and
+        compute the energy columns of the replicas of a restarted job for the
+        first exchange while the pilot is queued. (The AMBER templates and
+        the restraint table of the states are read by _checkInput(), since
+        the processes are started with them.)
+        """
+        self._startEnergyPool()
+        self._precomputeColumns()
+
+    def _startEnergyPool(self):
+        if self.energy_pool is None:
+            self._energyMatrix()
+            self.energy_pool = Pool(processes=self.exchange_processes,
+                                    initializer=_init_energy_worker,
+                                    initargs=(self.restraint_table,self.beta,
+                                              self.basename,
+                                              self.shared_energies,
+                                              self.nreplicas,
+                                              self.trace_nstlim,
+                                              self.bias_cutoff))
+
+    def _energyMatrix(self):
+        """
+        Return the energies of the replicas in the states, U[state,replica],
+        in shared memory, so that the processes of the pool write the columns
+        in place (see async_re_job._energyMatrix()).
+        """
+        if self.energy_matrix is None:
+            n = self.nreplicas
+            self.shared_energies = RawArray('d',n*n)
+            self.energy_matrix = frombuffer(self.shared_energies).reshape(n,n)
+        return self.energy_matrix
  
     def _computeSwapMatrix(self, replicas, states):
         """
@@ -132,38 +284,67 @@ class amberus_async_re_job(pj_amber_job):
                      = beta[U_0(x_i) + U_i(x_i)] + beta[U_0(x_j) + U_j(x_j)]
                        - beta[U_0(x_j) + U_i(x_j)] - beta[U_0(x_i) + U_j(x_i)]
                      =  beta[U_i(x_i) + U_i(x_j) - U_i(x_j) - U_j(x_i)]
+
+        (see _computeEnergyColumns())
         """ 
+        self._computeEnergyColumns(replicas)
+        return self._energyMatrix()
+
+    def _computeEnergyColumns(self, replicas):
+        """
+        Compute the reduced energies of the given replicas in all of the
+        states with the processes started by setupJob(), which only read the
+        restraint coordinates of the replicas (see restraint_coordinates())
+        and write the energies straight into the shared _energyMatrix().
+        """
         cycles = [self.status[repl]['cycle_current'] for repl in replicas]
-              
-        nprocs = cpu_count()
-        if nprocs >= 2*len(replicas):
-            nprocs = 1
-        pool = Pool(processes=nprocs)
-        # Divide replicas evenly amongst processes. Add extra replicas to the
-        # first few processes as needed to reach len(replicas). 
-        avg_replicas_per_proc = int(len(replicas)/nprocs)
-        replicas_per_proc = [avg_replicas_per_proc for n in range(nprocs)]
-        for n in range(len(replicas)%nprocs):
-            replicas_per_proc[n] += 1
-
-        repl_cyc_pairs = []
-        for n in range(nprocs):
-            first = sum(replicas_per_proc[0:n])
-            last = first + replicas_per_proc[n]
-            repl_cyc_pairs.append(zip(replicas[first:last],
-                                      cycles[first:last]))
-
-        print 'Computing swap matrix on %d processor(s)...'%nprocs
-        results = [pool.apply_async(_compute_columns,
-                                    args=(repl_cyc_pairs[n],states,
-                                          self.command_file))
-                   for n in range(nprocs)]
-        U = zeros([self.nreplicas,self.nreplicas])
-        for result in results:
-            U += asarray(result.get())
-        pool.close()
-        pool.join()
-        return U.tolist()
+        self._startEnergyPool()
+
+        print ('Computing %d swap matrix column(s) on %d processor(s)...'
+               %(len(replicas),self.exchange_processes))
+        self.energy_pool.map(_compute_column,zip(replicas,cycles))
+        return True
+
+    def _cachedSwapMatrix(self, replicas, states):
+        """
+        Return the swap matrix (see async_re_job._cachedSwapMatrix()) or,
+        with a BIAS_CUTOFF, only the energies computed among the waiting
+        replicas, as a dict U[(state_id, replica)] (see ExchangeSampler).
+        """
+        U = pj_amber_job._cachedSwapMatrix(self,replicas,states)
+        if self.bias_cutoff is None:
+            return U
+        block = U[ix_(states,replicas)]
+        a,i = (~isnan(block)).nonzero()
+        keys = zip(asarray(states)[a].tolist(),asarray(replicas)[i].tolist())
+        return dict(zip(keys,block[a,i].tolist()))
+
+    def _energyColumn(self, repl, cyc):
+        """
+        Return the reduced energies of replica repl at the end of cycle cyc
+        in all of the states (NaN beyond BIAS_CUTOFF).
+        """
+        r = restraint_coordinates(self.restraint_table,repl,cyc,self.basename,
+                                  self.trace_nstlim)
+        return bias_energies(self.restraint_table,self.beta,r,self.bias_cutoff)
+
+    def _stateCoordinates(self):
+        """The coordinates of the umbrella states are the bias positions."""
+        return self.bias_positions
+
+    def _reducedEnergies(self, repl, states):
+        """
+        Return the reduced energies, beta*U_i(x), of replica repl in the
+        given states (see _computeSwapMatrix()), whether or not they are
+        within BIAS_CUTOFF.
+        """
+        cyc = self.status[repl]['cycle_current']
+        if self.exchange_crds.get(repl,(None,None))[0] != cyc:
+            r = restraint_coordinates(self.restraint_table,repl,cyc,
+                                      self.basename,self.trace_nstlim)
+            self.exchange_crds[repl] = (cyc,r)
+        r = self.exchange_crds[repl][1]
+        return list(self.beta*self.restraint_table.coord_energies(r,states))
 
     def _hasCompleted(self, repl, cyc):
         """Returns True if an umbrella sampling replica has completed a cycle.
@@ -176,23 +357,34 @@ class amberus_async_re_job(pj_amber_job):
         else:
             return False
 
-def _compute_columns(replicas_and_cycles, states, command_file):
-    keywords = ConfigObj(command_file)
-    state_objs = amber_states_from_configobj(keywords)  
-    setup_us_states_from_configobj(state_objs,keywords)
-    nreplicas = len(state_objs) 
-    temp0 = state_objs.state_params_are_same('cntrl','temp0')
-    beta = 1./(at.KB*temp0)
-    basename = keywords.get('ENGINE_INPUT_BASENAME')
+# restraint parameters of the states, beta, basename, MD steps of a cycle
+# and BIAS_CUTOFF of the job and the shared energy matrix, set once in each
+# process of the swap matrix pool (see _init_energy_worker())
+_worker_table = None
+_worker_beta = None
+_worker_basename = None
+_worker_nstlim = None
+_worker_cutoff = None
+_worker_matrix = None
+
+def _init_energy_worker(table, beta, basename, shared_energies, nreplicas,
+                        nstlim, cutoff):
+    global _worker_table, _worker_beta, _worker_basename, _worker_nstlim
+    global _worker_cutoff, _worker_matrix
+    _worker_table = table
+    _worker_beta = beta
+    _worker_basename = basename
+    _worker_nstlim = nstlim
+    _worker_cutoff = cutoff
+    _worker_matrix = frombuffer(shared_energies).reshape(nreplicas,nreplicas)
 
-    U = zeros([nreplicas,nreplicas])
-    for repl_i,cyc_n in replicas_and_cycles:
-        crds_i = extract_amber_coordinates(repl_i,cyc_n,basename)
-        for sid_j in states:
-            # energy of replica i in state j
-            u_ji = state_objs[sid_j].rstr.energy(crds_i)
-            U[sid_j,repl_i] = beta*u_ji
-    return U
+def _compute_column(replica_and_cycle):
+    # reduced energies of a replica in all of the states, written in place
+    repl_i,cyc_n = replica_and_cycle
+    r_i = restraint_coordinates(_worker_table,repl_i,cyc_n,_worker_basename,
+                                _worker_nstlim)
+    _worker_matrix[:,repl_i] = bias_energies(_worker_table,_worker_beta,r_i,
+                                             _worker_cutoff)
 
 if __name__ == '__main__':
     import sys
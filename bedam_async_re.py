@@ -1,4 +1,4 @@
-import sys, time, random, math
+import sys, time, math
 from pj_async_re import async_re_job
 from impact_async_re import pj_impact_job
 
@@ -95,7 +95,7 @@ Performs exchange of lambdas for BEDAM replica exchange.
             print "%d %s %s" % (repl_b, lambda_b, u_b)
             print "dl = %f du = %f delta = %f" % (dl,du,delta)
 
-        csi = random.random()
+        csi = self.rng.stream('exchange').random_sample()
         if math.exp(-self.bedam_beta*delta) > csi:
             if self.keywords.get('VERBOSE') == "yes":
                 print "Accepted %f %f" % (math.exp(-self.bedam_beta*delta),csi)
@@ -122,10 +122,15 @@ Extracts binding energy from Impact output
         return float(self._extractLast_BindingEnergy(repl,cycle))
 
     def _getPar(self,repl):
-        sid = self.status[repl]['stateid_current']
+        return self._getStatePar(self.status[repl]['stateid_current'])
+
+    def _getStatePar(self,sid):
         lmb = self.lambdas[sid]
         return float(lmb)
 
+    def _stateCoordinates(self):
+        return [[float(lmb)] for lmb in self.lambdas]
+
     def _reduced_energy(self,par,pot):
         # par: list of parameters
         # pot: list of potentials
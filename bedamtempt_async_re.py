@@ -1,4 +1,4 @@
-import sys, time, random, math
+import sys, time, math
 from pj_async_re import async_re_job
 from bedam_async_re import bedam_async_re_job
 
@@ -117,7 +117,7 @@ Performs exchange of lambdas for BEDAM replica exchange.
             print "%d %f %f %f %f" % (repl_b, lambda_b, u_b, beta_b, h_b)
             print "dl = %f du = %f dh = %f delta = %f" % (dl,du,dh,delta)
 
-        csi = random.random()
+        csi = self.rng.stream('exchange').random_sample()
         if math.exp(-delta) > csi:
             if self.keywords.get('VERBOSE') == "yes":
                 print "Accepted %f %f" % (math.exp(-delta),csi)
@@ -174,13 +174,19 @@ watch cat BASENAME_stat.txt
         return (e0,float(u))
 
     def _getPar(self,repl):
-        sid = self.status[repl]['stateid_current']
+        return self._getStatePar(self.status[repl]['stateid_current'])
+
+    def _getStatePar(self,sid):
         lmb = float(self.stateparams[sid]['lambda'])
         tempt = float(self.stateparams[sid]['temperature'])
         kb = 0.0019872041
         beta = 1./(kb*tempt)
         return (beta,lmb)
 
+    def _stateCoordinates(self):
+        return [[float(st['lambda']),float(st['temperature'])]
+                for st in self.stateparams]
+
     def _reduced_energy(self,par,pot):
         # par: list of parameters
         # pot: list of potentials
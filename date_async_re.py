@@ -11,7 +11,7 @@ Issues a command to launch /bin/date using PJ
         compute_unit_description = {
             "executable": "/bin/date",
             "arguments": [""],
-            "total_cpu_count": int(self.keywords.get('SUBJOB_CORES')),            
+            "total_cpu_count": self._replicaCores(replica),            
             "output": "sj-stdout-"+str(replica)+"-"+str(cycle)+".txt",
             "error": "sj-stderr-"+str(replica)+"-"+str(cycle)+".txt",   
             "working_directory":os.getcwd()+"/r"+str(replica),
@@ -19,7 +19,7 @@ Issues a command to launch /bin/date using PJ
         }  
         if self.keywords.get('VERBOSE') == "yes":
             print "Launching %s in directory %s cycle %d" % ("/bin/date",os.getcwd()+"/r"+str(replica),cycle)
-        compute_unit=self.cds.submit_compute_unit(compute_unit_description)
+        compute_unit=self._submitComputeUnit(replica,compute_unit_description)
 
         #self.cus[replica]=compute_unit
         return compute_unit
@@ -73,8 +73,10 @@ if __name__ == '__main__':
 
     rx.setupJob()
 
-    while rx.pilotcompute.get_state() != "Running":
-        time.sleep(2)
+    if len(rx._runningPilots()) == 0:
+        rx._prepareWhileQueued()
+    while len(rx._runningPilots()) == 0:
+        time.sleep(1)
     
 # Gets the wall clock time for a replica to complete a cycle
 # If unspecified it is estimated as 10% of job wall clock time  
@@ -96,6 +98,7 @@ if __name__ == '__main__':
         rx.updateStatus()
         rx.print_status()
         rx.launchJobs()
+        rx._adjustPilots(rx.walltime - (time.time() - start_time)/60.)
         
         time.sleep(cycle_time)
 
@@ -0,0 +1,190 @@
+"""
+Online statistics of the exchanges of an asynchronous RE job
+
+ExchangeStatistics accumulates, exchange after exchange:
+
+- the observed state-to-state transition counts of the replicas over each
+  exchange (state before -> state after);
+- the expected (Rao-Blackwellised) transition matrix of a single Gibbs
+  step, i.e. the sum over the steps of the exchange of the probabilities
+  of the moves of the replicas between the states rather than of the moves
+  drawn (see ExchangeSampler.track_transitions()), which converges much
+  faster than the observed counts. Exact and block draws make no Gibbs
+  steps in the sampler; for those, the swap probabilities of a single
+  visit of each replica from the permutation reached at the end of the
+  exchange are added instead (a one-snapshot estimate);
+- the Metropolis acceptance probabilities of swaps between pairs of
+  states, from that final permutation;
+- the state trajectories of the replicas;
+- the round trips of the replicas between the lowest and the highest
+  state ids, and their durations.
+
+The statistics are kept in numpy arrays and written to disk by flush():
+the matrices and round trips to BASENAME_xstats.npz (rewritten each time)
+and the trajectories appended to BASENAME.xtraj, one row of int32 state
+ids of all of the replicas for each exchange, the times of which are in
+the npz file.
+"""
+import os
+
+from numpy import (zeros, ones, exp, maximum, isnan, ix_, arange, asarray,
+                   array, append, int32, load, savez)
+
+__all__ = ['ExchangeStatistics']
+
+# number of replicas whose swap probabilities are computed at once
+_CHUNK_SIZE = 256
+
+class ExchangeStatistics(object):
+    """Online statistics of the exchanges among nstates states."""
+    def __init__(self, nstates, nreplicas):
+        self.nstates = nstates
+        self.nreplicas = nreplicas
+        self.observed = zeros((nstates,nstates))
+        self.expected = zeros((nstates,nstates))
+        self.visits = zeros(nstates)
+        self.acceptance_sum = zeros((nstates,nstates))
+        self.pair_counts = zeros((nstates,nstates))
+        self.exchange_times = zeros(0)
+        # round trips (lowest -> highest -> lowest state): stage of the
+        # current trip (0 not started, -1 left from the lowest state, 1
+        # reached the highest state), time of the last arrival at the lowest
+        # state, number and total duration of the round trips of each replica
+        self.rt_last = zeros(nreplicas,dtype=int32)
+        self.rt_start = zeros(nreplicas)
+        self.rt_counts = zeros(nreplicas,dtype=int32)
+        self.rt_time_sum = zeros(nreplicas)
+        self.trajectory = []
+
+    def record(self, sampler, states, t):
+        """
+        Record an exchange done by sampler (an ExchangeSampler, at the end
+        of the exchange, on which track_transitions() was called before
+        sampling) at time t, states being the states of all of the replicas
+        after the exchange.
+        """
+        before = asarray(sampler.states)
+        after = before[sampler.perm]
+        self.observed[before,after] += 1.
+        stepped = (sampler.transitions is not None and
+                   sampler.transition_visits.sum() > 0)
+        if stepped:
+            self.expected[ix_(before,before)] += sampler.transitions
+            self.visits[before] += sampler.transition_visits
+        self._record_swap_probabilities(sampler,after,not stepped)
+        states = asarray(states,dtype=int32)
+        self._record_round_trips(states,t)
+        self.trajectory.append(states)
+        self.exchange_times = append(self.exchange_times,t)
+
+    def _record_swap_probabilities(self, sampler, after, snapshot):
+        """
+        Add the acceptance probabilities of the swaps of each replica from
+        the current permutation of sampler and, if snapshot is true, the
+        swap probabilities of a Gibbs visit of each replica to the expected
+        transitions (see ExchangeSampler.visit() and metropolis_sweep()).
+        Energies that were not computed (NaN) count as swaps that are never
+        proposed.
+        """
+        n = sampler.nreplicas
+        # E[k,j]: energy of replica j in the state of replica k
+        E = sampler.W[sampler.perm,:]
+        diag = E[arange(n),arange(n)]
+        if not snapshot:
+            proposal = None
+        elif sampler.neighbors is None:
+            proposal = ones((n,n))/max(n - 1.,1.)
+        else:
+            dmax = max([len(nbrs) for nbrs in sampler.neighbors] + [1])
+            proposal = zeros((n,n))
+            for k in range(n):
+                a = sampler.perm[k]
+                proposal[k,[sampler.inv[b] for b in sampler.neighbors[a]]] = (
+                    1./dmax)
+        for first in range(0,n,_CHUNK_SIZE):
+            rows = arange(first,min(first+_CHUNK_SIZE,n))
+            du = (E[rows,:] + E[:,rows].T - diag[rows,None] - diag[None,:])
+            proposed = ~isnan(du)
+            proposed[arange(len(rows)),rows] = False
+            acc = exp(-maximum(du,0.))
+            acc[~proposed] = 0.
+            pairs = ix_(after[rows],after)
+            self.acceptance_sum[pairs] += acc
+            self.pair_counts[pairs] += proposed
+            if snapshot:
+                ps = proposal[rows,:]*acc
+                self.expected[pairs] += ps
+                self.expected[after[rows],after[rows]] += 1. - ps.sum(axis=1)
+        if snapshot:
+            self.visits[after] += 1.
+
+    def _record_round_trips(self, states, t):
+        lowest = (states == 0)
+        highest = (states == self.nstates - 1)
+        done = lowest & (self.rt_last == 1)
+        self.rt_counts[done] += 1
+        self.rt_time_sum[done] += t - self.rt_start[done]
+        arrived = lowest & (self.rt_last != -1)
+        self.rt_start[arrived] = t
+        self.rt_last[lowest] = -1
+        self.rt_last[highest & (self.rt_last == -1)] = 1
+
+    def transition_matrices(self):
+        """
+        Return the observed and the expected state-to-state transition
+        matrices, normalized by row (rows of states not visited are zero).
+        """
+        observed = self.observed/maximum(self.observed.sum(axis=1),1.)[:,None]
+        expected = self.expected/maximum(self.visits,1.)[:,None]
+        return observed,expected
+
+    def acceptance(self):
+        """
+        Return the mean acceptance probabilities of swaps between pairs of
+        states (NaN for pairs never proposed).
+        """
+        acceptance = self.acceptance_sum/maximum(self.pair_counts,1.)
+        acceptance[self.pair_counts == 0] = float('nan')
+        return acceptance
+
+    def round_trip_times(self):
+        """
+        Return the number of round trips and their mean duration (NaN if
+        none) for each replica.
+        """
+        times = self.rt_time_sum/maximum(self.rt_counts,1)
+        times[self.rt_counts == 0] = float('nan')
+        return self.rt_counts,times
+
+    def flush(self, basename):
+        """
+        Write the statistics to BASENAME_xstats.npz and append the state
+        trajectories recorded since the last flush to BASENAME.xtraj.
+        """
+        if len(self.trajectory) > 0:
+            f = open('%s.xtraj'%basename,'ab')
+            array(self.trajectory,dtype=int32).tofile(f)
+            f.close()
+            self.trajectory = []
+        f = open('%s_xstats.npz'%basename,'wb')
+        savez(f,observed=self.observed,expected=self.expected,
+              visits=self.visits,acceptance_sum=self.acceptance_sum,
+              pair_counts=self.pair_counts,exchange_times=self.exchange_times,
+              rt_last=self.rt_last,rt_start=self.rt_start,
+              rt_counts=self.rt_counts,rt_time_sum=self.rt_time_sum)
+        f.close()
+
+    def restore(self, basename):
+        """
+        Continue the statistics saved in BASENAME_xstats.npz, if any, and
+        return True if they were found.
+        """
+        filename = '%s_xstats.npz'%basename
+        if not os.path.exists(filename):
+            return False
+        saved = load(filename)
+        if saved['observed'].shape != self.observed.shape:
+            return False
+        for name in saved.files:
+            setattr(self,name,saved[name])
+        return True
@@ -0,0 +1,209 @@
+"""
+Statistical validation and benchmark of the exchange samplers
+
+Draws the state permutations of a set of replicas many times with each of
+the samplers of gibbs_sampling, from random swap matrices or from swap
+matrices archived by a run (SWAP_ARCHIVE), and reports for each sampler the
+samples per second and the Kullback-Liebler divergence of the sampled
+distribution of permutations from the exact one, next to the divergence
+expected from the finite sample alone.
+
+The permutations are stored as integer codes (their rank in lexicographic
+order, see permutation_codes()) in arrays, and the exact distribution of
+all of the n! permutations is computed in log space, so up to about 9
+replicas can be checked.
+
+python exchange_validation.py [options]
+"""
+import sys
+import time
+from itertools import permutations
+from optparse import OptionParser
+
+from numpy import (zeros, ones, arange, array, asarray, exp, log, int32,
+                   int64, bincount, cumprod, where, inf, nan, isnan)
+from numpy.random import RandomState
+
+from gibbs_sampling import ExchangeSampler, pairwise_independence_sampling
+
+__all__ = ['permutation_codes', 'exact_log_distribution', 'kl_divergence',
+           'validate_sampler', 'SAMPLERS']
+
+def permutation_codes(perms):
+    """
+    Return the ranks in lexicographic order (Lehmer codes) of the
+    permutations of range(n) in the rows of perms.
+    """
+    perms = asarray(perms)
+    n = perms.shape[1]
+    # weights (n-1)!, (n-2)!, ..., 0!
+    factorials = cumprod([1] + range(1,n))[::-1].astype(int64)
+    codes = zeros(len(perms),dtype=int64)
+    for i in range(n-1):
+        smaller = (perms[:,i+1:] < perms[:,i:i+1]).sum(axis=1)
+        codes += smaller*factorials[i]
+    return codes
+
+def exact_log_distribution(W):
+    """
+    Return the log probabilities of all of the permutations perm of the
+    states of a set of replicas, p(perm) ~ exp(-sum_i W[perm[i],i]), in
+    lexicographic order of the permutations (that is, indexed by their
+    codes, see permutation_codes()). Energies not computed (NaN) are left
+    out as by ExchangeSampler, replica i starting in state i.
+    """
+    W = asarray(W,dtype=float)
+    n = len(W)
+    held = isnan(W.diagonal())
+    W = where(isnan(W),inf,W)
+    W[:,held] = inf
+    W[held,held] = 0.
+    perms = array(list(permutations(range(n))),dtype=int32)
+    u = W[perms,arange(n)].sum(axis=1)
+    umin = u.min()
+    logz = -umin + log(exp(-(u - umin)).sum())
+    return -u - logz
+
+def kl_divergence(codes, logq):
+    """
+    Return the Kullback-Liebler divergence of the distribution of sampled
+    permutation codes from the distribution with log probabilities logq.
+    """
+    counts = bincount(codes,minlength=len(logq)).astype(float)
+    p = counts/counts.sum()
+    sampled = p > 0.
+    return (p[sampled]*(log(p[sampled]) - logq[sampled])).sum()
+
+def _sample_sweep(sampler, nsamples, perms):
+    for m in xrange(nsamples):
+        sampler.sweep(1)
+        perms[m] = sampler.perm
+
+def _sample_metropolis(sampler, nsamples, perms):
+    for m in xrange(nsamples):
+        sampler.metropolis_sweep(1)
+        perms[m] = sampler.perm
+
+def _sample_exact(sampler, nsamples, perms):
+    for m in xrange(nsamples):
+        sampler.exact_sample()
+        perms[m] = sampler.perm
+
+def _sample_blocks(sampler, nsamples, perms):
+    block_size = max(sampler.nreplicas/2,2)
+    for m in xrange(nsamples):
+        sampler.block_sample(block_size,(m % 2)*(block_size/2),exact_max=0)
+        perms[m] = sampler.perm
+
+def _sample_pairwise(sampler, nsamples, perms):
+    # the original sampler, one replica at a time on lists
+    n = sampler.nreplicas
+    U = sampler.W.tolist()
+    replicas = range(n)
+    states = range(n)
+    for m in xrange(nsamples):
+        for i in replicas:
+            j = pairwise_independence_sampling(i,states[i],replicas,states,U,
+                                               sampler.rng)
+            states[i],states[j] = states[j],states[i]
+        perms[m] = states
+
+# samplers to validate: one sample is one sweep over the replicas, a block
+# sweep or an exact draw
+SAMPLERS = {'sweep': _sample_sweep,
+            'metropolis': _sample_metropolis,
+            'exact': _sample_exact,
+            'blocks': _sample_blocks,
+            'pairwise': _sample_pairwise}
+
+def validate_sampler(name, W, nsamples, seed=None):
+    """
+    Draw nsamples permutations with the sampler name (see SAMPLERS) for the
+    swap matrix W of n replicas in n states and return the samples per
+    second and the Kullback-Liebler divergence from the exact distribution.
+    """
+    n = len(W)
+    sampler = ExchangeSampler(range(n),range(n),W,rng=RandomState(seed))
+    perms = zeros((nsamples,n),dtype=int32)
+    start_time = time.time()
+    SAMPLERS[name](sampler,nsamples,perms)
+    rate = nsamples/max(time.time() - start_time,1.e-9)
+    return rate,kl_divergence(permutation_codes(perms),
+                              exact_log_distribution(W))
+
+def _recorded_matrices(basename, nreplicas):
+    # swap matrices of nreplicas waiting replicas archived by a run
+    from swap_archive import read_swap_archive
+    for event in read_swap_archive(basename):
+        W = event['W']
+        if len(W) == nreplicas and not isnan(W).any():
+            yield W
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]',
+                          description='Validate and benchmark the exchange '
+                          'samplers against the exact distribution of state '
+                          'permutations.')
+    parser.add_option('-n','--nreplicas',type='int',default=6,
+                      help='number of replicas [default: %default]')
+    parser.add_option('-s','--samples',type='int',default=20000,
+                      help='samples per sampler and matrix '
+                      '[default: %default]')
+    parser.add_option('-m','--matrices',type='int',default=3,
+                      help='number of swap matrices [default: %default]')
+    parser.add_option('-e','--scale',type='float',default=2.,
+                      help='scale of the random reduced energies '
+                      '[default: %default]')
+    parser.add_option('-a','--archive',default=None,
+                      help='use the swap matrices archived for this '
+                      'basename (SWAP_ARCHIVE) instead of random ones')
+    parser.add_option('-c','--cutoff',type='float',default=None,
+                      help='leave out (NaN) the energies above this squared '
+                      'over 2 (as BIAS_CUTOFF does, in standard deviations); '
+                      'not supported by the pairwise sampler')
+    parser.add_option('-x','--samplers',default=','.join(sorted(SAMPLERS)),
+                      help='comma separated samplers [default: %default]')
+    parser.add_option('-r','--seed',type='int',default=None,
+                      help='random number seed')
+    options,args = parser.parse_args()
+    names = options.samplers.split(',')
+    for name in names:
+        if not SAMPLERS.has_key(name):
+            parser.error('Unknown sampler %s'%name)
+    if options.cutoff is not None and 'pairwise' in names:
+        names.remove('pairwise')
+    if options.nreplicas > 9:
+        parser.error('At most 9 replicas can be checked against the exact '
+                     'distribution')
+
+    rng = RandomState(options.seed)
+    if options.archive is not None:
+        matrices = []
+        for W in _recorded_matrices(options.archive,options.nreplicas):
+            matrices.append(W)
+            if len(matrices) == options.matrices:
+                break
+        if len(matrices) == 0:
+            print ('No archived exchanges of %d replicas for %s'
+                   %(options.nreplicas,options.archive))
+            sys.exit(1)
+    else:
+        matrices = [options.scale*rng.random_sample((options.nreplicas,
+                                                     options.nreplicas))
+                    for m in range(options.matrices)]
+    if options.cutoff is not None:
+        matrices = [where(W > 0.5*options.cutoff**2,nan,W) for W in matrices]
+
+    nperms = len(exact_log_distribution(ones((options.nreplicas,
+                                              options.nreplicas))))
+    # divergence of a finite sample of independent draws
+    noise = (nperms - 1.)/(2.*options.samples)
+    print ('%d replicas, %d swap matrices, %d samples (KL divergence of '
+           'independent samples about %.4f)'%(options.nreplicas,len(matrices),
+                                             options.samples,noise))
+    print '%-11s %8s %14s  %s'%('sampler','matrix','samples/s','KL divergence')
+    for name in names:
+        for m,W in enumerate(matrices):
+            rate,kl = validate_sampler(name,W,options.samples,
+                                       rng.randint(0,2**31-1))
+            print '%-11s %8d %14.0f  %.4f'%(name,m,rate,kl)
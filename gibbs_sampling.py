@@ -1,9 +1,18 @@
 """Gibbs sampling routines"""
-from numpy import zeros, exp, sum, log, asarray
-from numpy.random import random as _random
-from random import choice
+import sys
+import time
+import math
+from numpy import (zeros, exp, sum, log, asarray, arange, ix_, maximum,
+                   cumsum, array, empty, where, inf, nan, isnan, argsort,
+                   nansum)
+from numpy.fft import rfft, irfft
+import numpy.random
+from numpy.random import RandomState
 from itertools import permutations
 
+# largest number of replicas for which exact_sample() is used by default
+EXACT_SAMPLING_MAX = 20
+
 def _exit(message):
     """Print and flush a message to stdout and then exit."""
     print message
@@ -11,9 +20,9 @@ def _exit(message):
     print 'exiting...'
     sys.exit(1)
 
-def weighted_choice(choices):
+def weighted_choice(choices, rng=numpy.random):
     """Return a discrete outcome given a set of outcome/weight pairs."""
-    r = _random()*sum(w for c,w in choices)
+    r = rng.random_sample()*sum(w for c,w in choices)
     for c,w in choices:
         r -= w
         if r < 0:
@@ -21,7 +30,8 @@ def weighted_choice(choices):
     # You should never get here.
     return None
 
-def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
+def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U,
+                                 rng=numpy.random):
     """
     Return a replica "j" to exchange with the given replica "i" based on
     the Metropolis criterion:
@@ -40,7 +50,7 @@ def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
     nreplicas = len(replicas)
     repl_j = repl_i
     while repl_j == repl_i:
-        j = choice(range(nreplicas))
+        j = rng.randint(nreplicas)
         repl_j = replicas[j]
         sid_j = states[j]
     # Apply the Metropolis acceptance criteria. If the move is accepted, return
@@ -49,14 +59,15 @@ def pairwise_metropolis_sampling(repl_i, sid_i, replicas, states, U):
     du = (U[sid_i][repl_j] + U[sid_j][repl_i]
           - U[sid_i][repl_i] - U[sid_j][repl_j])
     if du > 0.:
-        if _random() > exp(-du):
+        if rng.random_sample() > exp(-du):
             return repl_i
         else:
             return repl_j
     else:
         return repl_j
     
-def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
+def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U,
+                                   rng=numpy.random):
     """
     Return a replica "j" to exchange with the given replica "i" based on
     independent sampling from the discrete Metropolis transition matrix, T:
@@ -112,7 +123,600 @@ def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
     except IndexError:
         _exit('gibbs_re_j(): unrecoverable error: replica %d not in the '
               'list of waiting replicas?'%i)
-    return replicas[weighted_choice(zip(range(nreplicas),ps))]
+    return replicas[weighted_choice(zip(range(nreplicas),ps),rng)]
+
+class ExchangeSampler(object):
+    """
+    Gibbs sampler of the state permutations of a set of replicas, drawing
+    from the same transition matrix as pairwise_independence_sampling() but
+    on arrays:
+
+    W[a,i] = U[states[a]][replicas[i]]
+
+    holds a copy of the energies of the replicas in the states they occupy
+    (U itself is not modified), and the current permutation is perm, the
+    replica in position i being in state states[perm[i]], and its inverse is
+    inv, the state in position a being occupied by the replica in position
+    inv[a]. Visiting replica i computes the exponents du of all of its
+    swaps in one vector operation and draws the swap partner from the
+    cumulative distribution (see visit()), or the replicas are paired at
+    random and the swaps of all of the pairs are accepted or rejected at
+    once with the Metropolis criterion (see metropolis_sweep()). For small
+    sets of replicas the permutation can also be drawn exactly, without a
+    Markov chain (see exact_sample()).
+
+    Swaps can be restricted to the edges of a graph of the states, given
+    as the list neighbors of the positions (in states) of the states
+    adjacent to each state. Only metropolis_sweep() and the methods built on
+    it support this. Entries of U may then be NaN (not computed), in which
+    case they are computed when first needed by calling
+    energy_function(replica, state_ids), which returns the energies of a
+    replica in a list of states. U may also be given as a dict of the
+    computed energies only, U[(state_id, replica)], the others being NaN.
+
+    Without a graph, entries of U may also be left out (NaN) for replicas
+    whose energies in distant states were not computed because swaps to
+    those states would hardly ever be accepted (as with the BIAS_CUTOFF of
+    umbrella sampling). A swap needing any of them is then never proposed,
+    and a replica whose energy in its own state was not computed stays in
+    that state. Since a swap and its reverse need the same four energies,
+    this keeps the proposals symmetric, and all of the samplers still draw
+    from the exact distribution over the permutations they can reach
+    (see _exactEnergies()). Entries may also be +inf (the swaps are then
+    proposed but never accepted).
+
+    The random numbers are drawn from rng, a numpy RandomState (such as a
+    stream of the RandomStreams of an RE job), or from the global numpy
+    random state by default.
+
+    After track_transitions(), every Gibbs step also accumulates the
+    transition probabilities of the replica moves it could make (see
+    track_transitions()).
+    """
+    def __init__(self, replicas, states, U, neighbors=None,
+                 energy_function=None, rng=None):
+        self.replicas = list(replicas)
+        self.states = list(states)
+        self.nreplicas = len(self.replicas)
+        if isinstance(U,dict):
+            self.W = empty((self.nreplicas,self.nreplicas))
+            self.W.fill(nan)
+            positions = dict([(sid,a) for a,sid in enumerate(self.states)])
+            columns = dict([(repl,i) for i,repl in enumerate(self.replicas)])
+            for (sid,repl),u in U.iteritems():
+                self.W[positions[sid],columns[repl]] = u
+        else:
+            self.W = asarray(U,dtype=float)[ix_(self.states,self.replicas)]
+        self.perm = arange(self.nreplicas)
+        self.inv = arange(self.nreplicas)
+        self._index = arange(self.nreplicas)
+        self.neighbors = neighbors
+        self.energy_function = energy_function
+        if rng is None:
+            rng = numpy.random
+        self.rng = rng
+        # subset partition functions of exact_sample() and the energies
+        # they are computed from, computed once
+        self._logZ = None
+        self._exact_W = None
+        # rows of the computed energies of metropolis_sweep() on a graph
+        self._rows = None
+        # accumulated transition probabilities (see track_transitions())
+        self.transitions = None
+        self.transition_visits = None
+
+    def track_transitions(self):
+        """
+        Accumulate from now on, at each Gibbs step, the probabilities of the
+        moves of the replicas between the states rather than only the moves
+        drawn: transitions[a,b] is the expected number of moves from the
+        state in position a (in states) to the state in position b, and
+        transition_visits[a] the number of steps made from state a. A
+        visit() of replica i adds its full row of swap probabilities, and
+        each swap proposed by metropolis_sweep() adds its acceptance
+        probability (and the rejection to the diagonal) for the replicas
+        involved, which on average over the partners is the same row. Exact
+        draws and block_sample() make no steps here and add nothing.
+        """
+        n = self.nreplicas
+        self.transitions = zeros((n,n))
+        self.transition_visits = zeros(n)
+
+    def visit(self, i):
+        """
+        Swap the state of the replica in position i with that of the replica
+        drawn from the Metropolis transition probabilities (possibly itself).
+        """
+        W = self.W
+        perm = self.perm
+        a = perm[i]
+        # du_j = u_a(x_j) + u_b(x_i) - u_a(x_i) - u_b(x_j), b = perm[j]
+        du = W[a,:] + W[perm,i] - W[a,i] - W[perm,self._index]
+        # ps_j = min[1,exp(-du_j)]/(n-1), ps_i = 1 - sum_(j != i) ps_j
+        ps = exp(-maximum(du,0.))/(self.nreplicas - 1.)
+        # (swaps needing energies not computed are not proposed)
+        ps[isnan(du)] = 0.
+        ps[i] = 0.
+        ps[i] = 1. - ps.sum()
+        if self.transitions is not None:
+            self.transitions[a,perm] += ps
+            self.transition_visits[a] += 1.
+        cps = cumsum(ps)
+        j = cps.searchsorted(self.rng.random_sample()*cps[-1],side='right')
+        if j != i:
+            perm[i],perm[j] = perm[j],perm[i]
+            self.inv[perm[i]] = i
+            self.inv[perm[j]] = j
+
+    def sweep(self, nsweeps=1):
+        """Visit each replica in turn, nsweeps times."""
+        for n in xrange(nsweeps):
+            for i in xrange(self.nreplicas):
+                self.visit(i)
+
+    def metropolis_sweep(self, nsweeps=1, time_budget=None, batch_size=100000,
+                         energies=None):
+        """
+        Do nsweeps Metropolis sweeps, each proposing swaps between pairs of
+        replicas which are accepted with probability min[1,exp(-du)], and
+        return the number of sweeps done. Each proposal costs O(1) instead
+        of the O(n) of visit(), which makes very long runs of sweeps
+        affordable.
+
+        Without a graph, a sweep pairs the replicas at random twice (a
+        random perfect matching of the positions, one replica being left out
+        if n is odd) and tests the swaps of all of the pairs of a matching at
+        once, on arrays: since the pairs are disjoint, their swaps do not
+        interact and each leaves the distribution of the permutation
+        invariant. The partner of each replica is uniform among the others,
+        as in visit(), and a sweep makes about n proposals.
+
+        With a graph of neighbors, the replicas are visited in turn and the
+        replica in state a proposes a swap with the replica in each state
+        adjacent to a with probability 1/dmax, dmax being the largest number
+        of neighbors of a state, and no swap otherwise, which keeps the
+        proposals symmetric. The energies not computed yet (NaN) are computed
+        when first needed (see _computeEntries()).
+
+        The partners and the acceptance thresholds (exponential variates, a
+        swap being accepted if du is below its threshold) are drawn for
+        batches of about batch_size proposals at a time. The sweeps stop
+        early once time_budget seconds (if given) have elapsed, checked
+        between batches. If a list of energies is given, the energy of the
+        permutation, sum_i W[perm[i],i], is appended to it after each sweep.
+        The transition probabilities are accumulated if tracked (see
+        track_transitions()).
+        """
+        if self.neighbors is None:
+            return self._matching_sweep(nsweeps,time_budget,batch_size,
+                                        energies)
+        n = self.nreplicas
+        # (the computed energies, kept from call to call)
+        if self._rows is None:
+            self._rows = _sparse_rows(self.W)
+        W = self._rows
+        perm = self.perm.tolist()
+        inv = self.inv.tolist()
+        batch = max(1,batch_size/n)
+        order = range(n)
+        neighbors = self.neighbors
+        dmax = max([len(nbrs) for nbrs in neighbors] + [1])
+        if energies is not None:
+            energy = self.energy()
+        tracked = self.transitions is not None
+        if tracked:
+            # (summed in a dict and a list, cheaper than array elements)
+            moves = {}
+            steps = [0]*n
+        start_time = time.time()
+        done = 0
+        while done < nsweeps:
+            m = int(min(batch,nsweeps - done))
+            # index of the proposed neighbor state (none if >= degree)
+            partners = self.rng.randint(0,dmax,size=(m,n))
+            thresholds = self.rng.standard_exponential((m,n))
+            for partners_row,thresholds_row in zip(partners.tolist(),
+                                                   thresholds.tolist()):
+                for i,j,t in zip(order,partners_row,thresholds_row):
+                    a = perm[i]
+                    if tracked:
+                        steps[a] += 1
+                    if j >= len(neighbors[a]):
+                        continue
+                    b = neighbors[a][j]
+                    j = inv[b]
+                    Wa = W[a]
+                    Wb = W[b]
+                    du = Wa[j] + Wb[i] - Wa[i] - Wb[j]
+                    if du != du:
+                        # (NaN) energies not computed yet
+                        self._computeEntries(W,i,b)
+                        self._computeEntries(W,j,a)
+                        du = Wa[j] + Wb[i] - Wa[i] - Wb[j]
+                    if tracked and du == du:
+                        if du > 0.:
+                            p = math.exp(-du)
+                        else:
+                            p = 1.
+                        moves[a,b] = moves.get((a,b),0.) + p
+                        moves[a,a] = moves.get((a,a),0.) - p
+                    if du < t:
+                        perm[i] = b
+                        perm[j] = a
+                        inv[a] = j
+                        inv[b] = i
+                        if energies is not None:
+                            energy += du
+                if energies is not None:
+                    energies.append(energy)
+            done += m
+            if time_budget is not None and time.time() - start_time > time_budget:
+                break
+        self.perm = array(perm)
+        self.inv = array(inv)
+        if tracked:
+            # (the diagonal holds the steps minus the moves away)
+            steps = asarray(steps,dtype=float)
+            self.transitions[self._index,self._index] += steps
+            self.transition_visits += steps
+            for (a,b),p in moves.iteritems():
+                self.transitions[a,b] += p
+        return done
+
+    def _matching_sweep(self, nsweeps, time_budget, batch_size, energies):
+        """Metropolis sweeps by random matchings (see metropolis_sweep())."""
+        n = self.nreplicas
+        W = self.W
+        perm = self.perm
+        half = n/2
+        T = self.transitions
+        # (swaps needing energies not computed are never accepted)
+        missing = isnan(W).any()
+        batch = max(1,batch_size/n)
+        if energies is not None:
+            energy = self.energy()
+        start_time = time.time()
+        done = 0
+        while done < nsweeps:
+            m = int(min(batch,nsweeps - done))
+            # two random matchings per sweep: the first half of a random
+            # order of the positions paired with the second half
+            orders = self.rng.random_sample((2*m,n)).argsort(axis=1)
+            thresholds = self.rng.standard_exponential((2*m,half))
+            for k in xrange(2*m):
+                i = orders[k,0:half]
+                j = orders[k,half:2*half]
+                a = perm[i]
+                b = perm[j]
+                du = W[a,j] + W[b,i] - W[a,i] - W[b,j]
+                if missing:
+                    du[isnan(du)] = inf
+                if T is not None:
+                    # (the states of a matching are all distinct)
+                    p = exp(-maximum(du,0.))
+                    T[a,b] += p
+                    T[b,a] += p
+                    T[a,a] += 1. - p
+                    T[b,b] += 1. - p
+                    self.transition_visits[a] += 1.
+                    self.transition_visits[b] += 1.
+                accepted = du < thresholds[k]
+                perm[i[accepted]] = b[accepted]
+                perm[j[accepted]] = a[accepted]
+                if energies is not None:
+                    energy += du[accepted].sum()
+                    if k % 2 == 1:
+                        energies.append(energy)
+            done += m
+            if time_budget is not None and time.time() - start_time > time_budget:
+                break
+        self.inv[perm] = self._index
+        return done
+
+    def _computeEntries(self, W, i, a):
+        """
+        Compute the energy of the replica in position i in the state in
+        position a if it is missing (NaN) in W and self.W, along with its
+        missing energies in the neighbors of a.
+        """
+        if W[a][i] == W[a][i]:
+            return
+        positions = [b for b in [a] + list(self.neighbors[a])
+                     if W[b][i] != W[b][i]]
+        energies = self.energy_function(self.replicas[i],
+                                        [self.states[b] for b in positions])
+        for b,u in zip(positions,energies):
+            W[b][i] = u
+            self.W[b,i] = u
+        self._logZ = None
+
+    def computed_entries(self):
+        """Return the number of energies computed (not NaN) in W."""
+        return int(self.W.size - isnan(self.W).sum())
+
+    def sweep_to_tolerance(self, tolerance=0.1, max_sweeps=None,
+                           time_budget=None, min_sweeps=20):
+        """
+        Do Metropolis sweeps (see metropolis_sweep()) until the energy of
+        the permutation has been sampled to the given relative precision,
+        that is until the standard error of its mean in units of its
+        standard deviation, sqrt(tau/nsweeps), falls below tolerance, tau
+        being the integrated autocorrelation time of the energies sampled
+        so far. This requires nsweeps >= tau/tolerance**2, long enough for
+        the chain to forget its starting permutation and for tau to be
+        estimated reliably. The number of sweeps is doubled between
+        estimates of tau. The sweeps also stop after max_sweeps sweeps or
+        time_budget seconds, if given. Return the number of sweeps done and
+        the last estimate of tau.
+        """
+        energies = []
+        start_time = time.time()
+        chunk = min_sweeps
+        done = 0
+        tau = 1.
+        while max_sweeps is None or done < max_sweeps:
+            if max_sweeps is not None:
+                chunk = min(chunk,max_sweeps - done)
+            if time_budget is not None:
+                remaining = time_budget - (time.time() - start_time)
+                if remaining <= 0.:
+                    break
+            else:
+                remaining = None
+            done += self.metropolis_sweep(chunk,remaining,energies=energies)
+            tau = integrated_autocorrelation_time(energies)
+            if done >= min_sweeps and tau/done < tolerance**2:
+                break
+            chunk = done
+        return done,tau
+
+    def energy(self):
+        """
+        Return the energy of the current permutation (that of the replicas
+        whose energies in their states were computed, the others being held
+        in their states).
+        """
+        return float(nansum(self.W[self.perm,self._index]))
+
+    def exact_sample(self):
+        """
+        Draw the permutation directly from its exact distribution,
+
+        p(perm) ~ exp(-sum_i W[perm[i],i]),
+
+        independently of the current one (no Markov chain, no mixing). The
+        positions are assigned states in turn, the state of position k being
+        drawn with the weights exp(-W[a,k])*Z(S+a), where S is the set of
+        states already taken and Z(S) is the sum of exp(-sum W) over the
+        assignments of the remaining states to the remaining positions (see
+        _subset_log_partition()). The cost is O(n 2^n) in time and O(2^n) in
+        memory, so this is meant for at most about 20 replicas. The Z(S) are
+        computed on the first draw only.
+        """
+        n = self.nreplicas
+        if self._logZ is None:
+            self._exact_W = self._exactEnergies()
+            self._logZ = self._subset_log_partition(self._exact_W)
+        W = self._exact_W
+        logZ = self._logZ
+        mask = 0
+        for k in xrange(n):
+            free = [a for a in xrange(n) if not (mask >> a) & 1]
+            logp = array([logZ[mask | (1 << a)] - W[a,k] for a in free])
+            p = exp(logp - logp.max())
+            cp = cumsum(p)
+            r = self.rng.random_sample()*cp[-1]
+            a = free[min(cp.searchsorted(r,side='right'),len(free)-1)]
+            self.perm[k] = a
+            self.inv[a] = k
+            mask |= 1 << a
+
+    def _exactEnergies(self):
+        """
+        Return W with the energies not computed (NaN) made infinite and the
+        replicas whose energies in their own states were not computed held
+        in those states, so that an exact draw is restricted to the
+        permutations the Markov chains can reach. These are the same for all
+        of them, since the replicas held never move and the others only
+        ever take states whose energies were computed.
+        """
+        W = where(isnan(self.W),inf,self.W)
+        for k in isnan(self.W[self.perm,self._index]).nonzero()[0]:
+            W[:,k] = inf
+            W[self.perm[k],k] = 0.
+        return W
+
+    def _subset_log_partition(self, W):
+        """
+        Return the array logZ, indexed by the bitmask of a set S of states,
+        of the log of the sum over the assignments of the other states to
+        the positions |S|,...,n-1 of exp(-sum W). By the recursion
+
+        Z(S) = sum_(a not in S) exp(-W[a,|S|]) Z(S+a),  Z(all) = 1,
+
+        evaluated in log space from the full set down, one layer of sets
+        of the same size at a time.
+        """
+        n = self.nreplicas
+        masks = arange(1 << n)
+        sizes = zeros(1 << n,dtype=int)
+        for a in xrange(n):
+            sizes += (masks >> a) & 1
+        logZ = empty(1 << n)
+        logZ.fill(-inf)
+        logZ[(1 << n) - 1] = 0.
+        for k in xrange(n-1,-1,-1):
+            layer = masks[sizes == k]
+            terms = empty((n,len(layer)))
+            for a in xrange(n):
+                terms[a] = where((layer >> a) & 1, -inf,
+                                 logZ[layer | (1 << a)] - W[a,k])
+            tmax = terms.max(axis=0)
+            # (with infinite energies, some sets have no assignment at all)
+            tmax[tmax == -inf] = 0.
+            total = exp(terms - tmax).sum(axis=0)
+            logZ[layer] = where(total > 0.,tmax + log(maximum(total,1.e-300)),
+                                -inf)
+        return logZ
+
+    def block_sample(self, block_size, offset=0, pool=None, nsweeps=1,
+                     exact_max=EXACT_SAMPLING_MAX, tolerance=None,
+                     time_budget=None):
+        """
+        Resample the permutation by blocks of states: the states are sorted
+        by id and cut into blocks of block_size consecutive states, the first
+        block ending at offset if offset > 0. The replicas in the states of
+        each block are exchanged among those states by an independent chain,
+        which leaves the distribution of the permutation invariant since it
+        factorizes given the replicas in each block. The blocks are sampled
+        in parallel with the map() of pool (a multiprocessing Pool), if
+        given. Alternating the offset (e.g. between 0 and block_size/2) from
+        call to call lets replicas move across block boundaries. This does
+        not reach all of the permutations if W has infinite entries or
+        entries not computed.
+
+        Each block is drawn exactly if it has at most exact_max states (see
+        exact_sample()) and is otherwise sampled with nsweeps Metropolis
+        sweeps, or until tolerance (see sweep_to_tolerance()), within
+        time_budget seconds. Return the number of blocks and the number of
+        sweeps done by the blocks (replica visits divided by n).
+        """
+        order = sorted(range(self.nreplicas),key=lambda a: self.states[a])
+        bounds = range(offset % block_size,self.nreplicas,block_size)
+        if len(bounds) == 0 or bounds[0] != 0:
+            bounds = [0] + bounds
+        bounds.append(self.nreplicas)
+        blocks = [order[first:last] for first,last in zip(bounds[0:-1],
+                                                          bounds[1:])
+                  if last - first >= 2]
+        tasks = []
+        for block in blocks:
+            members = [self.inv[a] for a in block]
+            tasks.append((self.W[ix_(block,members)],nsweeps,
+                          len(block) <= exact_max,tolerance,time_budget,
+                          self.rng.randint(0,2**31-1)))
+        if pool is not None:
+            results = pool.map(_sample_block,tasks)
+        else:
+            results = map(_sample_block,tasks)
+        visits = 0
+        for block,(perm,block_sweeps) in zip(blocks,results):
+            members = [self.inv[a] for a in block]
+            for i,k in zip(members,perm):
+                self.perm[i] = block[k]
+                self.inv[block[k]] = i
+            visits += block_sweeps*len(block)
+        return len(blocks),visits/self.nreplicas
+
+    def current_states(self):
+        """Return the current states of the replicas (in order)."""
+        return [self.states[a] for a in self.perm]
+
+class _SparseRow(dict):
+    """Row of a swap matrix holding only the computed energies."""
+    def __missing__(self, i):
+        return nan
+
+def _sparse_rows(W):
+    """Return the energies of W which are not NaN as a list of _SparseRow."""
+    rows = [_SparseRow() for a in xrange(len(W))]
+    positions = (~isnan(W)).nonzero()
+    for a,i,u in zip(positions[0].tolist(),positions[1].tolist(),
+                     W[positions].tolist()):
+        rows[a][i] = u
+    return rows
+
+def _sample_block(task):
+    """
+    Sample the permutation of a block of replicas (see
+    ExchangeSampler.block_sample()) with its own random seed, and return it
+    with the number of sweeps done (0 for an exact draw).
+    """
+    W,nsweeps,exact,tolerance,time_budget,seed = task
+    n = len(W)
+    sampler = ExchangeSampler(range(n),range(n),W,rng=RandomState(seed))
+    if exact:
+        sampler.exact_sample()
+        nsweeps = 0
+    elif tolerance is not None:
+        nsweeps,tau = sampler.sweep_to_tolerance(tolerance,None,time_budget)
+    else:
+        nsweeps = sampler.metropolis_sweep(nsweeps,time_budget)
+    return sampler.perm.tolist(),nsweeps
+
+def grid_neighbors(coordinates):
+    """
+    Return the neighbors of states on a (possibly irregular) grid, given the
+    coordinates of each state in parameter space, as a list of the sorted
+    state ids of the neighbors of each state. Two states are neighbors if
+    they differ in one coordinate only and no other state with the same
+    remaining coordinates lies between them.
+    """
+    nstates = len(coordinates)
+    neighbors = [set() for sid in range(nstates)]
+    ndim = len(coordinates[0])
+    for d in range(ndim):
+        lines = {}
+        for sid,x in enumerate(coordinates):
+            key = tuple(x[0:d]) + tuple(x[d+1:])
+            lines.setdefault(key,[]).append((x[d],sid))
+        for line in lines.itervalues():
+            line.sort()
+            for (x1,sid1),(x2,sid2) in zip(line[0:-1],line[1:]):
+                neighbors[sid1].add(sid2)
+                neighbors[sid2].add(sid1)
+    return [sorted(nbrs) for nbrs in neighbors]
+
+def knn_neighbors(coordinates, k):
+    """
+    Return the neighbors of states given their coordinates in parameter
+    space, as a list of the sorted state ids of the neighbors of each state.
+    Each state is a neighbor of its k nearest states and of the states of
+    which it is one of the k nearest. Each coordinate is scaled by its range
+    so that different parameters (e.g. lambda and temperature) weigh the
+    same.
+    """
+    x = asarray(coordinates,dtype=float)
+    spread = x.max(axis=0) - x.min(axis=0)
+    spread[spread == 0.] = 1.
+    x = x/spread
+    d2 = ((x[:,None,:] - x[None,:,:])**2).sum(axis=2)
+    nstates = len(x)
+    neighbors = [set() for sid in range(nstates)]
+    for sid in range(nstates):
+        d2[sid,sid] = inf
+        for nid in argsort(d2[sid],kind='mergesort')[0:min(k,nstates-1)]:
+            neighbors[sid].add(int(nid))
+            neighbors[int(nid)].add(sid)
+    return [sorted(nbrs) for nbrs in neighbors]
+
+def integrated_autocorrelation_time(x, c=5.):
+    """
+    Return the integrated autocorrelation time, in samples, of a series:
+
+    tau = 1 + 2 sum_(t=1)^(M-1) rho(t),
+
+    where rho is the normalized autocorrelation function (from FFTs) and
+    the window M is the smallest such that M >= c*tau (Sokal's automatic
+    windowing). A constant series returns 1.
+    """
+    x = asarray(x,dtype=float)
+    n = len(x)
+    if n < 2:
+        return 1.
+    x = x - x.mean()
+    f = rfft(x,2*n)
+    acf = irfft(f*f.conjugate())[0:n]
+    if acf[0] <= 0.:
+        return 1.
+    rho = acf/acf[0]
+    taus = 2.*cumsum(rho) - 1.
+    window = arange(n) >= c*taus
+    if window.any():
+        tau = taus[window.argmax()]
+    else:
+        tau = taus[-1]
+    return max(tau,1.)
 
 def state_perm_distribution(replicas, states, swap_matrix):
     """
@@ -181,3 +785,56 @@ def discrete_Kullback_Liebler_divergence(p, q, dx=1.0, eps=1e-9):
     q = asarray(q)
     p[p < eps] = eps
     return (p*log(p/q)*dx).sum()
+
+if __name__ == '__main__':
+    # Check the block-parallel sampler against the serial sampler: the
+    # distribution of state permutations of a few replicas (Kullback-Liebler
+    # divergence from the exact distribution) and the time of the same
+    # number of sweeps on many replicas. The blocks only pay off if the
+    # sweeps of the serial chain take longer than sending the blocks to the
+    # processes and sampling them there.
+    from multiprocessing import Pool, cpu_count
+    from numpy.random import random_sample
+
+    nsamples = 20000
+    U = 2.*random_sample((6,6))
+    replicas = range(6)
+    states = range(6)
+    exact = state_perm_distribution(replicas,states,U)
+    for label,block_size,exact_max in (('serial',None,0),
+                                       ('blocks, sweeps',3,0),
+                                       ('blocks, exact',3,3)):
+        sampler = ExchangeSampler(replicas,states,U)
+        counts = {}
+        for n in xrange(nsamples):
+            if block_size is None:
+                sampler.metropolis_sweep(1)
+            else:
+                sampler.block_sample(block_size,(n % 2)*(block_size/2),
+                                     exact_max=exact_max)
+            perm = str(zip(replicas,sampler.current_states()))
+            counts[perm] = counts.get(perm,0) + 1.
+        empirical = sample_to_state_perm_distribution(counts,replicas,states)
+        print '%-16s KL divergence from exact: %.4f'%(
+            label,state_perm_divergence(empirical,exact))
+    print '(%d samples, expected about %.4f)'%(nsamples,359.5/nsamples)
+
+    nreplicas = 4000
+    nsweeps = 200
+    nprocs = cpu_count()
+    U = 10.*random_sample((nreplicas,nreplicas))
+    sampler = ExchangeSampler(range(nreplicas),range(nreplicas),U)
+    start_time = time.time()
+    sampler.metropolis_sweep(nsweeps)
+    serial_time = time.time() - start_time
+    # (the pool is started beforehand, as by an RE job)
+    pool = Pool(processes=nprocs)
+    start_time = time.time()
+    nblocks,block_sweeps = sampler.block_sample(500,0,pool,nsweeps,
+                                                exact_max=0)
+    block_time = time.time() - start_time
+    pool.close()
+    pool.join()
+    print '%d replicas, %d sweeps:'%(nreplicas,nsweeps)
+    print '  serial:                    %8.2f s'%serial_time
+    print '  %3d blocks, %3d processes: %8.2f s'%(nblocks,nprocs,block_time)
@@ -7,16 +7,33 @@ class pj_impact_job(async_re_job):
          """
 Launches Impact sub-job using pilot-job
 """
-         num_threads = os.getenv('OMP_NUM_THREADS')
+         # OpenMP threads per replica, from the OMP_NUM_THREADS keyword
+         # (e.g. as set by autotuning) or else the controller's environment
+         num_threads = self.keywords.get('OMP_NUM_THREADS')
          if num_threads == None:
-             num_threads = 1
+             num_threads = os.getenv('OMP_NUM_THREADS')
+         if num_threads == None:
+             impact_env = []
          else:
-             num_threads = int(num_threads)
+             impact_env = ["OMP_NUM_THREADS=%d" % int(num_threads)]
 
          input_file = "%s_%d.inp" % (self.basename, cycle)
          log_file = "%s_%d.log" % (self.basename, cycle)
          err_file = "%s_%d.err" % (self.basename, cycle)
 
+         executable = os.getcwd()+"/runimpact"
+         arguments = [input_file]
+         if self.affinity != 'none':
+             # wrap runimpact in a run script that binds it to its cores
+             wdir = os.getcwd()+"/r"+str(replica)
+             run_script = open(wdir+"/run",'w')
+             run_script.write('cd %s\n' % wdir)
+             run_script.write(self._affinityScript(self._replicaCores(replica)))
+             run_script.write('$PIN %s %s\n' % (executable, input_file))
+             run_script.close()
+             executable = "/bin/bash run"
+             arguments = []
+
          schrod_env = None
 
           # Parallelism
@@ -45,9 +62,10 @@ Launches Impact sub-job using pilot-job
 
 	 #pilotjob: Compute Unit (i.e. Job) description
          compute_unit_description = {
-            "executable": os.getcwd()+"/runimpact",
-            "arguments": [input_file],
-            "total_cpu_count": int(self.keywords.get('SUBJOB_CORES')),
+            "executable": executable,
+            "environment": impact_env,
+            "arguments": arguments,
+            "total_cpu_count": self._replicaCores(replica),
             "output": log_file,
             "error": err_file,   
             "working_directory":os.getcwd()+"/r"+str(replica),
@@ -55,10 +73,10 @@ Launches Impact sub-job using pilot-job
          }  
 
          if self.keywords.get('VERBOSE') == "yes":
-            print "Launching %s %s in directory %s cycle %d" % (os.getcwd()+"/runimpact",input_file,os.getcwd()+"/r"+str(replica),cycle)
+            print "Launching %s %s in directory %s cycle %d" % (executable," ".join(arguments),os.getcwd()+"/r"+str(replica),cycle)
 
 #         compute_unit=self.cds.submit_compute_unit(compute_unit_description)
-         compute_unit=self.pilotcompute.submit_compute_unit(compute_unit_description)
+         compute_unit=self._submitComputeUnit(replica,compute_unit_description)
          return compute_unit
 
     def _getImpactData(self, file):
@@ -167,4 +185,29 @@ Returns true if an IMPACT replica has successfully completed a cycle.
                 U[sid_j][repl_i] = self._reduced_energy(par[j],pot[i])
         return U
 
+    def _reducedEnergies(self, repl, states):
+        """
+        Return the reduced energies of replica repl in the given states
+        (see _computeSwapMatrix()).
+        """
+        pot = self._getPot(repl,self.status[repl]['cycle_current'])
+        return [self._reduced_energy(self._getStatePar(sid),pot)
+                for sid in states]
+
+    def _warmUp(self):
+        """
+        Compute the energy columns of the replicas of a restarted job for the
+        first exchange while the pilot is queued.
+        """
+        self._precomputeColumns()
+
+    def _energyColumn(self, repl, cyc):
+        """
+        Return the reduced energies of replica repl at the end of cycle cyc
+        in all of the states.
+        """
+        pot = self._getPot(repl,cyc)
+        return [self._reduced_energy(self._getStatePar(sid),pot)
+                for sid in range(self.nreplicas)]
+
 
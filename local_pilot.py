@@ -0,0 +1,251 @@
+"""
+Local stand-in for the BigJob pilot-job API
+
+Implements the part of the BigJob API used by ASyncRE (PilotComputeService,
+ComputeDataService, PilotCompute and ComputeUnit) with local processes, so
+that RE jobs can be run and tested on a workstation without a queuing system
+or a redis server. It is selected with a RESOURCE_URL of the form
+local://localhost.
+
+A pilot owns 'number_of_processes' cores, numbered from 0. It starts running
+after 'queue_wait' seconds (0 by default), to stand in for the time a BigJob
+spends in the queue. Compute units are started first come, first served as
+soon as enough cores are free. The ids
+of the cores assigned to a unit are passed to it in the ASYNCRE_CPUSET
+environment variable, which the run scripts use to pin the replica (see the
+AFFINITY setting).
+"""
+import os
+import time
+import signal
+import threading
+import subprocess
+
+__all__ = ['PilotComputeService', 'ComputeDataService', 'PilotCompute',
+           'ComputeUnit', 'LOCAL_URL_PREFIX']
+
+LOCAL_URL_PREFIX = 'local://'
+
+class PilotComputeService(object):
+    """Create and keep track of local pilots."""
+    def __init__(self, coordination_url=None):
+        self.pilots = []
+
+    def create_pilot(self, pilot_compute_description):
+        pilot = PilotCompute(pilot_compute_description)
+        self.pilots.append(pilot)
+        return pilot
+
+    def list_pilots(self):
+        return list(self.pilots)
+
+    def cancel(self):
+        for pilot in self.pilots:
+            pilot.cancel()
+
+
+class ComputeDataService(object):
+    """Wait on the pilots of the pilot compute services added to it."""
+    def __init__(self):
+        self.services = []
+
+    def add_pilot_compute_service(self, pilot_compute_service):
+        self.services.append(pilot_compute_service)
+
+    def wait(self):
+        for service in self.services:
+            for pilot in service.list_pilots():
+                pilot.wait()
+
+    def cancel(self):
+        # The pilots are canceled by their pilot compute service.
+        pass
+
+
+class PilotCompute(object):
+    """
+    A set of local cores on which compute units are run. A background thread
+    starts queued units when cores become free and collects finished ones.
+    """
+    def __init__(self, pilot_compute_description):
+        self.description = dict(pilot_compute_description)
+        self.ncores = int(self.description['number_of_processes'])
+        self.free_cores = range(self.ncores)
+        self.queue = []
+        self.units = []
+        self.state = 'New'
+        self.submit_time = time.time()
+        self.start_time = (self.submit_time +
+                           float(self.description.get('queue_wait',0.)))
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_state(self):
+        return self.state
+
+    def get_details(self):
+        return {'submit_time': self.submit_time,
+                'start_time': self.start_time,
+                'number_of_processes': self.ncores}
+
+    def submit_compute_unit(self, compute_unit_description):
+        unit = ComputeUnit(compute_unit_description,self)
+        with self.lock:
+            self.units.append(unit)
+            if unit.ncores > self.ncores:
+                unit.state = 'Failed'
+            else:
+                self.queue.append(unit)
+        return unit
+
+    def list_compute_units(self):
+        return list(self.units)
+
+    def wait(self):
+        """Wait until all of the compute units have finished."""
+        while [unit for unit in self.units if not unit.is_finished()]:
+            time.sleep(1)
+
+    def cancel(self):
+        with self.lock:
+            for unit in self.units:
+                unit._terminate()
+            self.queue = []
+            self.state = 'Canceled'
+
+    def _cancel_unit(self, unit):
+        with self.lock:
+            if unit in self.queue:
+                self.queue.remove(unit)
+                unit.state = 'Canceled'
+            elif unit.state == 'Running':
+                unit._terminate()
+                self.free_cores.extend(unit.cores)
+
+    def _assign_cores(self, ncores):
+        """
+        Return a set of ncores free cores, preferably an aligned block (which
+        does not straddle sockets when ncores divides the socket size).
+        """
+        free = set(self.free_cores)
+        for first in range(0,self.ncores-ncores+1,ncores):
+            block = range(first,first+ncores)
+            if free.issuperset(block):
+                return block
+        return sorted(free)[0:ncores]
+
+    def _run(self):
+        while self.state == 'New' and time.time() < self.start_time:
+            time.sleep(0.2)
+        with self.lock:
+            if self.state == 'New':
+                self.state = 'Running'
+        while self.state == 'Running':
+            with self.lock:
+                for unit in self.units:
+                    if unit.state == 'Running' and unit._poll():
+                        self.free_cores.extend(unit.cores)
+                while self.queue and self.queue[0].ncores <= len(self.free_cores):
+                    unit = self.queue.pop(0)
+                    cores = self._assign_cores(unit.ncores)
+                    for core in cores:
+                        self.free_cores.remove(core)
+                    if not unit._start(cores):
+                        self.free_cores.extend(cores)
+            time.sleep(0.2)
+
+
+class ComputeUnit(object):
+    """A process run on a set of cores of a local pilot."""
+    def __init__(self, compute_unit_description, pilot):
+        self.description = dict(compute_unit_description)
+        self.pilot = pilot
+        self.ncores = int(self.description.get('number_of_processes',
+                          self.description.get('total_cpu_count',1)))
+        self.cores = []
+        self.process = None
+        self.state = 'New'
+        self.details = {'submit_time': time.time()}
+
+    def get_state(self):
+        return self.state
+
+    def get_details(self):
+        return dict(self.details)
+
+    def is_finished(self):
+        return self.state in ('Done','Failed','Canceled')
+
+    def cancel(self):
+        self.pilot._cancel_unit(self)
+
+    def wait(self):
+        while not self.is_finished():
+            time.sleep(1)
+
+    def _start(self, cores):
+        """
+        Start the process on the given cores and return True, or mark the
+        unit as failed and return False if it cannot be started.
+        """
+        self.cores = cores
+        env = dict(os.environ)
+        for var in self.description.get('environment') or []:
+            name,value = var.split('=',1)
+            env[name] = value
+        env['ASYNCRE_CPUSET'] = ','.join([str(core) for core in cores])
+        wdir = self.description.get('working_directory',os.getcwd())
+        command = ' '.join([self.description['executable']] +
+                           [str(arg) for arg in
+                            self.description.get('arguments') or []])
+        stdout = None
+        stderr = None
+        try:
+            stdout = open(os.path.join(wdir,self.description.get('output',
+                                                                 'stdout')),
+                          'w')
+            stderr = open(os.path.join(wdir,self.description.get('error',
+                                                                 'stderr')),
+                          'w')
+            self.process = subprocess.Popen(command,shell=True,cwd=wdir,
+                                            env=env,stdout=stdout,
+                                            stderr=stderr,
+                                            preexec_fn=os.setsid)
+            self.state = 'Running'
+        except (IOError,OSError), e:
+            print 'Warning: unable to start %s in %s: %s'%(command,wdir,e)
+            self.state = 'Failed'
+        for f in (stdout,stderr):
+            if f is not None:
+                f.close()
+        self.details['start_time'] = time.time()
+        self.details['end_queue_time'] = self.details['start_time']
+        if self.state == 'Failed':
+            self.details['end_time'] = self.details['start_time']
+            self.cores = []
+            return False
+        return True
+
+    def _poll(self):
+        """Return True if the process has just exited."""
+        returncode = self.process.poll()
+        if returncode is None:
+            return False
+        if returncode == 0:
+            self.state = 'Done'
+        else:
+            self.state = 'Failed'
+        self.details['end_time'] = time.time()
+        return True
+
+    def _terminate(self):
+        if self.state == 'Running' and self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid,signal.SIGTERM)
+            except OSError:
+                pass
+            self.details['end_time'] = time.time()
+        if not self.is_finished():
+            self.state = 'Canceled'
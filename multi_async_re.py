@@ -0,0 +1,258 @@
+"""
+Run several asynchronous RE jobs on one shared pilot
+
+A multi-job command file lists the command files of the RE jobs to run in
+JOBS and describes the pilot(s) they share, with the same settings as a
+single job (RESOURCE_URL, TOTAL_CORES, etc. or sections of them). Each job
+runs in the directory of its command file with its own status files and
+exchanges, as if it were run alone, except that the pilot settings of the
+multi-job command file replace its own.
+
+The cores of the pilots are shared among the jobs in proportion to their
+JOB_PRIORITY settings (weighted max-min fair share): a job that needs less
+than its share gets what it needs and the rest is shared among the others.
+
+Usage: python multi_async_re.py <ConfigFile>
+"""
+import os
+import sys
+import time
+
+from configobj import ConfigObj
+
+from pj_async_re import _exit, _split_keyword, PILOT_KEYWORDS
+
+# module and class of the RE job for each RE_TYPE
+RE_JOB_CLASSES = {'DATE': ('date_async_re', 'date_async_re_job'),
+                  'BEDAM': ('bedam_async_re', 'bedam_async_re_job'),
+                  'BEDAMTEMPT': ('bedamtempt_async_re',
+                                 'bedamtempt_async_re_job'),
+                  'AMBERUS': ('amberus_async_re', 'amberus_async_re_job')}
+
+# settings of the multi-job command file imposed on each job
+SHARED_KEYWORDS = PILOT_KEYWORDS + ('WALL_TIME', 'BJ_WORKING_DIR',
+                                    'SUBJOBS_BUFFER_SIZE', 'ELASTIC',
+                                    'ELASTIC_CORES', 'ELASTIC_MAX_PILOTS',
+                                    'ELASTIC_GROW_CHECKS',
+                                    'ELASTIC_SHRINK_CHECKS')
+
+def fair_shares(demands, weights, total):
+    """
+    Return the weighted max-min fair shares of total among consumers with
+    the given demands and weights: each consumer gets at most its demand
+    and the rest is split in proportion to the weights.
+    """
+    shares = [0. for demand in demands]
+    active = [j for j in range(len(demands)) if demands[j] > 0]
+    remaining = float(total)
+    while len(active) > 0 and remaining > 0.:
+        wsum = float(sum([weights[j] for j in active]))
+        offers = dict([(j,remaining*weights[j]/wsum) for j in active])
+        satisfied = [j for j in active if demands[j] - shares[j] <= offers[j]]
+        if len(satisfied) == 0:
+            for j in active:
+                shares[j] += offers[j]
+            break
+        for j in satisfied:
+            remaining -= demands[j] - shares[j]
+            shares[j] = demands[j]
+            active.remove(j)
+    return shares
+
+class multi_async_re_job(object):
+    """
+    Class to run several asynchronous RE jobs on one shared pilot
+    """
+    def __init__(self, command_file):
+        self.command_file = command_file
+        self.keywords = ConfigObj(self.command_file)
+        if self.keywords.get('JOBS') is None:
+            _exit('JOBS needs to be specified')
+        if self.keywords.get('WALL_TIME') is None:
+            _exit('WALL_TIME (in minutes) needs to be specified')
+        self.walltime = float(self.keywords.get('WALL_TIME'))
+        if (self.keywords.get('VERBOSE') is not None and
+            self.keywords.get('VERBOSE').lower() == 'yes'):
+            self.verbose = True
+        else:
+            self.verbose = False
+
+        options = {}
+        for key in SHARED_KEYWORDS:
+            if self.keywords.get(key) is not None:
+                options[key] = self.keywords.get(key)
+        for name in self.keywords.sections:
+            if self.keywords[name].get('RESOURCE_URL') is not None:
+                options[name] = self.keywords[name].dict()
+        if options.get('BJ_WORKING_DIR') is None:
+            options['BJ_WORKING_DIR'] = os.getcwd()
+        # (the shared pilots are grown and shrunk by the first job only)
+        if options.get('ELASTIC') is None:
+            options['ELASTIC'] = 'no'
+
+        self.basedir = os.getcwd()
+        self.jobs = []
+        self.jobdirs = []
+        for job_file in _split_keyword(self.keywords.get('JOBS')):
+            job_file = os.path.abspath(job_file.strip())
+            if not os.path.exists(job_file):
+                _exit('No such job command file: %s'%job_file)
+            re_type = ConfigObj(job_file).get('RE_TYPE')
+            if not RE_JOB_CLASSES.has_key(re_type):
+                _exit('Unsupported RE_TYPE %s in %s'%(re_type,job_file))
+            module,name = RE_JOB_CLASSES[re_type]
+            job_class = getattr(__import__(module),name)
+            self.jobdirs.append(os.path.dirname(job_file))
+            os.chdir(self.jobdirs[-1])
+            try:
+                self.jobs.append(job_class(job_file,options))
+            finally:
+                os.chdir(self.basedir)
+
+        self.priorities = []
+        for job in self.jobs:
+            if job.keywords.get('JOB_PRIORITY') is not None:
+                priority = float(job.keywords.get('JOB_PRIORITY'))
+            else:
+                priority = 1.
+            if priority <= 0.:
+                _exit('JOB_PRIORITY of %s must be positive'%job.command_file)
+            self.priorities.append(priority)
+
+    def _each_job(self, method, *args):
+        """Call a method of each job in its own directory."""
+        for job,jobdir in zip(self.jobs,self.jobdirs):
+            os.chdir(jobdir)
+            try:
+                getattr(job,method)(*args)
+            finally:
+                os.chdir(self.basedir)
+
+    def setupJob(self):
+        """
+        Set up the jobs, launching the pilot(s) with the first one which are
+        then shared by the others. The processes of all of the jobs are
+        started first, before the pilot(s) and the threads of any job.
+        """
+        self._each_job('_startPools')
+        for n,(job,jobdir) in enumerate(zip(self.jobs,self.jobdirs)):
+            if n > 0:
+                job.share_pilots(self.jobs[0])
+            os.chdir(jobdir)
+            try:
+                job.setupJob()
+            finally:
+                os.chdir(self.basedir)
+
+    def _shareCores(self):
+        """
+        Set the core budget of each job to its fair share of the cores of
+        the running pilots (with the buffer of SUBJOBS_BUFFER_SIZE). The
+        demand of a job is the cores of its replicas, less the two kept
+        waiting for exchanges.
+        """
+        first = self.jobs[0]
+        if first.keywords.get('SUBJOBS_BUFFER_SIZE') is not None:
+            subjobs_buffer_size = float(
+                first.keywords.get('SUBJOBS_BUFFER_SIZE'))
+        else:
+            subjobs_buffer_size = 0.5
+        pilots = first._runningPilots()
+        if len(pilots) == 0:
+            # (replicas submitted while the pilots are queued)
+            pilots = [p for p,pilot in enumerate(first.pilots)
+                      if pilot['phase'] == 'active']
+        total = int((1.+subjobs_buffer_size)*
+                    sum([first.pilots[p]['cores'] for p in pilots]))
+        demands = []
+        for job in self.jobs:
+            cores = sorted([job._replicaCores(k)
+                            for k in range(job.nreplicas)])
+            demands.append(sum(cores[0:max(len(cores)-2,0)]))
+        shares = fair_shares(demands,self.priorities,total)
+        for job,share in zip(self.jobs,shares):
+            job.core_budget = int(share + 0.5)
+            if self.verbose:
+                print 'job %s: core budget %d'%(job.jobname,job.core_budget)
+
+    def scheduleJobs(self):
+        """
+        Run the jobs on the shared pilot(s), one round of launches and
+        exchanges for each job every CYCLE_TIME seconds, until WALL_TIME.
+        """
+        first = self.jobs[0]
+        # use the time in the queue to get ready for the first cycle
+        if len(first._runningPilots()) == 0:
+            self._shareCores()
+            self._each_job('_prepareWhileQueued')
+        # wait until a bigjob enters executing
+        while len(first._runningPilots()) == 0:
+            time.sleep(1)
+
+        if self.keywords.get('REPLICA_RUN_TIME') is None:
+            replica_run_time = int(round(self.walltime/10.))
+        else:
+            replica_run_time = int(self.keywords.get('REPLICA_RUN_TIME'))
+        # double it to give time for current running processes
+        # and newly submitted processes to complete
+        replica_run_time *= 2
+        if self.keywords.get('CYCLE_TIME') is None:
+            cycle_time = 30.0
+        else:
+            cycle_time = float(self.keywords.get('CYCLE_TIME'))
+
+        start_time = time.time()
+        end_time = (start_time + 60*(self.walltime - replica_run_time) -
+                    cycle_time - 10)
+        while time.time() < end_time:
+            time.sleep(1)
+
+            self._each_job('updateStatus')
+            self._shareCores()
+            self._each_job('launchJobs')
+            self._each_job('updateStatus')
+            self._each_job('print_status')
+            # (with ELASTIC, for the replicas of all of the jobs)
+            first._adjustPilots((end_time - time.time())/60. +
+                                replica_run_time)
+
+            time.sleep(cycle_time)
+
+            self._each_job('updateStatus')
+            self._each_job('print_status')
+            self._each_job('doExchanges')
+
+        self._each_job('updateStatus')
+        self._each_job('print_status')
+        # the pilots are shared: wait for and cancel them once, then write
+        # out the exchanges of each job in its own directory
+        first.waitJob()
+        first._cancelPilots()
+        self._each_job('finalizeJob')
+
+if __name__ == '__main__':
+
+    # Parse arguments:
+    usage = "%prog <ConfigFile>"
+
+    if len(sys.argv) != 2:
+        print "Please specify ONE input file"
+        sys.exit(1)
+
+    commandFile = sys.argv[1]
+
+    print ""
+    print "===================================="
+    print "Multi-job Asynchronous Replica Exchange "
+    print "===================================="
+    print ""
+    print "Started at: " + str(time.asctime())
+    print "Input file:", commandFile
+    print ""
+    sys.stdout.flush()
+
+    rx = multi_async_re_job(commandFile)
+
+    rx.setupJob()
+
+    rx.scheduleJobs()
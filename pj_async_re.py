@@ -9,15 +9,29 @@ Brian Radak <radakb@biomaps.rutgers.edu>
 Melissa Romanus <melissa.romanus@rutgers.edu>
 """
 import os
+import re
 import sys
 import time
+import zlib
 import pickle
-import random
+import Queue
+import threading
+from multiprocessing import Pool, cpu_count
 
 from configobj import ConfigObj
+from numpy import zeros, isfinite
+from numpy.random import RandomState
 
 from gibbs_sampling import *
-from pilot import PilotComputeService, ComputeDataService, State
+import local_pilot
+from exchange_stats import ExchangeStatistics
+from swap_archive import SwapMatrixArchive
+try:
+    from pilot import (PilotComputeService, ComputeDataService, PilotCompute,
+                       State)
+except ImportError:
+    # BigJob is not needed to run on the local backend (local:// URLs).
+    PilotComputeService = ComputeDataService = PilotCompute = State = None
 
 __version__ = '0.2.1'
 
@@ -28,6 +42,106 @@ def _exit(message):
     print 'exiting...'
     sys.exit(1)
 
+def _split_keyword(value):
+    """
+    Return a keyword value as a list. ConfigObj only splits unquoted comma
+    delimited values, quoted ones are split here.
+    """
+    if isinstance(value,str):
+        return value.split(',')
+    return list(value)
+
+# Bash fragment of the replica run scripts which sets PIN to a command prefix
+# binding the replica to a set of @ncores@ core(s) of its node. The cores are
+# those assigned by the pilot in ASYNCRE_CPUSET (local backend) or else are
+# claimed among the @ppn@ cores of the node with per-core lock directories,
+# shared by the replicas of the job running on the same node.
+AFFINITY_SCRIPT = """# CPU affinity (AFFINITY = @affinity@)
+NCORES=@ncores@
+PPN=@ppn@
+CORES_PER_SOCKET=@cores_per_socket@
+LOCKDIR=${TMPDIR:-/tmp}/asyncre_affinity_@jobname@_$USER
+CLAIMED=""
+release_cores() {
+    for c in $CLAIMED; do rm -rf $LOCKDIR/core$c; done
+}
+claim_core() {
+    if mkdir $LOCKDIR/core$1 2>/dev/null; then
+        echo $$ > $LOCKDIR/core$1/pid
+        return 0
+    fi
+    # take over the lock of a run that is gone
+    pid=$(cat $LOCKDIR/core$1/pid 2>/dev/null)
+    if [ -n "$pid" ] && ! kill -0 $pid 2>/dev/null; then
+        rm -rf $LOCKDIR/core$1
+        if mkdir $LOCKDIR/core$1 2>/dev/null; then
+            echo $$ > $LOCKDIR/core$1/pid
+            return 0
+        fi
+    fi
+    return 1
+}
+if [ -z "$ASYNCRE_CPUSET" ]; then
+    mkdir -p $LOCKDIR
+    trap release_cores EXIT
+    trap 'exit 143' TERM INT
+    first=0
+    while [ -z "$CLAIMED" ] && [ $((first+NCORES)) -le $PPN ]; do
+        for ((c=first; c<first+NCORES; c++)); do
+            if claim_core $c; then
+                CLAIMED="$CLAIMED $c"
+            else
+                release_cores
+                CLAIMED=""
+                break
+            fi
+        done
+        first=$((first+NCORES))
+    done
+    ASYNCRE_CPUSET=$(echo $CLAIMED | tr ' ' ',')
+fi
+if [ -n "$ASYNCRE_CPUSET" ] && [ "@affinity@" = "socket" ]; then
+    socket=$(( ${ASYNCRE_CPUSET%%,*} / CORES_PER_SOCKET ))
+    ASYNCRE_CPUSET=$((socket*CORES_PER_SOCKET))-$(((socket+1)*CORES_PER_SOCKET-1))
+fi
+PIN=""
+if [ -n "$ASYNCRE_CPUSET" ] && taskset -c $ASYNCRE_CPUSET true 2>/dev/null; then
+    PIN="taskset -c $ASYNCRE_CPUSET"
+    if [ "@affinity@" = "core" ]; then
+        export OMP_PLACES=cores
+        export OMP_PROC_BIND=close
+    fi
+fi
+"""
+
+# Settings that describe a pilot-job. Each may be set in a section of the
+# command file, to run on several pilots, or at the top level.
+PILOT_KEYWORDS = ('RESOURCE_URL', 'QUEUE', 'TOTAL_CORES', 'PPN', 'PROJECT',
+                  'COORDINATION_URL', 'SGE_WAYNESS', 'LOCAL_QUEUE_WAIT')
+
+class RandomStreams(object):
+    """
+    Independent random number streams (numpy RandomStates), one for each
+    subsystem of an RE job that draws random numbers (exchanges, launch
+    order, etc.), returned by stream(name). With a seed, each stream is
+    seeded from the seed and its name, so that a run can be replayed exactly
+    and adding a stream does not change the others; without one, streams
+    are seeded from the operating system. The streams are pickled with the
+    status of the job.
+    """
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.streams = {}
+
+    def stream(self, name):
+        if not self.streams.has_key(name):
+            if self.seed is None:
+                self.streams[name] = RandomState()
+            else:
+                self.streams[name] = RandomState(
+                    [self.seed,zlib.crc32(name) & 0xffffffff])
+        return self.streams[name]
+
 def _open(name, mode, max_attempts = 100, wait_time = 1):
     """
     Convenience function for opening files on an unstable filesystem.
@@ -61,7 +175,35 @@ class async_re_job(object):
         self.cus = {}
         self.jobname = os.path.splitext(os.path.basename(command_file))[0]
         self.keywords = ConfigObj(self.command_file)
+        # settings imposed on top of the command file, such as those of the
+        # pilot shared by several jobs (see multi_async_re)
+        if options is not None:
+            for key,value in options.iteritems():
+                self.keywords[key] = value
+        # pilots shared with other jobs (see share_pilots())
+        self.pilots = None
+        self.peer_jobs = []
+        self.core_budget = None
+        # exchange statistics (see setupJob())
+        self.exchange_stats = None
+        self.swap_archive = None
+        # energies of the replicas in all of the states, U[state,replica],
+        # the cycle of each replica they were computed for (see
+        # _cachedSwapMatrix()) and the replicas and cycles of the last
+        # exchange
+        self.energy_matrix = None
+        self.energy_cycles = {}
+        self.last_exchange = None
+        # completed replica cycles whose columns are computed in the
+        # background (see _startColumnWorker())
+        self.column_queue = None
+        # processes sampling the blocks of exchanges (see setupJob())
+        self.exchange_pool = None
         self._checkInput()
+        # (absolute, since the pilots of several jobs can be shared by a
+        # controller running in another directory, see multi_async_re)
+        self.pilot_file = os.path.abspath('%s.pilot'%self.basename)
+        self.rng = RandomStreams(self.rng_seed)
         self._printStatus()
 
     def _exit(self, message):
@@ -128,12 +270,7 @@ class async_re_job(object):
         if self.walltime is None:
             self._exit('WALL_TIME (in minutes) needs to be specified')
         # variables required for PilotJob
-        if self.keywords.get('COORDINATION_URL') is None:
-            self._exit('COORDINATION_URL needs to be specified')
-        if self.keywords.get('RESOURCE_URL') is None:
-            self._exit('RESOURCE_URL needs to be specified')
-        if self.keywords.get('QUEUE') is None:
-            self._exit('QUEUE needs to be specified')
+        self._parsePilots()
         if self.keywords.get('BJ_WORKING_DIR') is None:
             basedir = os.getcwd()
         else:
@@ -142,10 +279,9 @@ class async_re_job(object):
         if not os.path.exists(self.bj_working_dir):
             os.mkdir(self.bj_working_dir)
 
-        if self.keywords.get('TOTAL_CORES') is None:
-            self._exit('TOTAL_CORES needs to be specified')
         if self.keywords.get('SUBJOB_CORES') is None:
             self._exit('SUBJOB_CORES needs to be specified')
+        self._parseSubjobCores()
 
         # Optional variables
         #
@@ -159,6 +295,30 @@ class async_re_job(object):
             self.ppn = int(self.keywords.get('PPN'))
         else:
             self.ppn = 1
+        # binding of replicas to cores (see _affinityScript())
+        self.affinity = self.keywords.get('AFFINITY')
+        if self.affinity is None:
+            self.affinity = 'none'
+        self.affinity = self.affinity.lower()
+        if self.affinity not in ('none','core','socket'):
+            self._exit('AFFINITY must be one of none, core or socket')
+        if self.affinity != 'none':
+            if self.keywords.get('PPN') is None:
+                if [spec for spec in self.pilot_specs if
+                    not spec['RESOURCE_URL'].startswith(
+                        local_pilot.LOCAL_URL_PREFIX)]:
+                    self._exit('PPN (cores per node) needs to be specified to '
+                               'use AFFINITY')
+                self.ppn = max([spec['TOTAL_CORES']
+                                for spec in self.pilot_specs])
+            if self.keywords.get('SOCKETS_PER_NODE') is not None:
+                sockets = int(self.keywords.get('SOCKETS_PER_NODE'))
+            else:
+                sockets = 1
+            if sockets < 1 or self.ppn%sockets != 0:
+                self._exit('PPN (%d) must be a multiple of SOCKETS_PER_NODE '
+                           '(%d)'%(self.ppn,sockets))
+            self.cores_per_socket = self.ppn/sockets
         # spmd_variation for PilotJob (may override this later)
         if self.keywords.get('SPMD') is not None: 
             self.spmd = self.keywords.get('SPMD')
@@ -171,6 +331,88 @@ class async_re_job(object):
             self.nexchg_rounds = int(self.keywords.get('NEXCHG_ROUNDS'))
         else:
             self.nexchg_rounds = 1
+        # relative precision of the permutation energy at which sweeps stop
+        if self.keywords.get('EXCHANGE_TOLERANCE') is not None:
+            self.exchange_tolerance = float(
+                self.keywords.get('EXCHANGE_TOLERANCE'))
+            if self.exchange_tolerance <= 0.:
+                self._exit('EXCHANGE_TOLERANCE must be positive')
+        else:
+            self.exchange_tolerance = None
+        # maximum time in seconds spent sampling exchanges (see doExchanges())
+        if self.keywords.get('EXCHANGE_TIME_BUDGET') is not None:
+            self.exchange_time_budget = float(
+                self.keywords.get('EXCHANGE_TIME_BUDGET'))
+        elif self.nexchg_rounds < 0 or self.exchange_tolerance is not None:
+            self.exchange_time_budget = 10.
+        else:
+            self.exchange_time_budget = None
+        # largest set of waiting replicas sampled exactly (see doExchanges()),
+        # none by default since the cost grows as 2**n
+        if self.keywords.get('EXCHANGE_EXACT_MAX') is not None:
+            self.exchange_exact_max = int(
+                self.keywords.get('EXCHANGE_EXACT_MAX'))
+            if self.exchange_exact_max > EXACT_SAMPLING_MAX:
+                self._exit('EXCHANGE_EXACT_MAX must be at most %d'
+                           %EXACT_SAMPLING_MAX)
+        else:
+            self.exchange_exact_max = 0
+        # graph of the states between which exchanges are attempted
+        if self.keywords.get('EXCHANGE_GRAPH') is not None:
+            self.exchange_graph = self.keywords.get('EXCHANGE_GRAPH').lower()
+        else:
+            self.exchange_graph = 'all'
+        if self.exchange_graph not in ('all','grid','knn'):
+            self._exit('EXCHANGE_GRAPH must be one of all, grid or knn')
+        if self.keywords.get('EXCHANGE_NEIGHBORS') is not None:
+            self.exchange_neighbors = int(
+                self.keywords.get('EXCHANGE_NEIGHBORS'))
+        else:
+            self.exchange_neighbors = None
+        self.state_neighbors = None
+        # block-parallel exchanges for large numbers of waiting replicas
+        if self.keywords.get('EXCHANGE_BLOCK_SIZE') is not None:
+            self.exchange_block_size = int(
+                self.keywords.get('EXCHANGE_BLOCK_SIZE'))
+            if self.exchange_block_size < 2:
+                self._exit('EXCHANGE_BLOCK_SIZE must be at least 2')
+        else:
+            self.exchange_block_size = None
+        if self.keywords.get('EXCHANGE_PROCESSES') is not None:
+            self.exchange_processes = int(
+                self.keywords.get('EXCHANGE_PROCESSES'))
+        else:
+            self.exchange_processes = cpu_count()
+        # block boundaries alternate from exchange to exchange
+        self.exchange_block_offset = 0
+        # exchanges between writes of the exchange statistics, 0 for none
+        if self.keywords.get('EXCHANGE_STATS_INTERVAL') is not None:
+            self.exchange_stats_interval = int(
+                self.keywords.get('EXCHANGE_STATS_INTERVAL'))
+        else:
+            self.exchange_stats_interval = 10
+        # archive of the swap matrices (see swap_archive)
+        if (self.keywords.get('SWAP_ARCHIVE') is not None and
+            self.keywords.get('SWAP_ARCHIVE').lower() == 'yes'):
+            self.swap_archive_mode = True
+        else:
+            self.swap_archive_mode = False
+        if self.keywords.get('SWAP_ARCHIVE_CHUNK') is not None:
+            self.swap_archive_chunk = int(
+                self.keywords.get('SWAP_ARCHIVE_CHUNK'))
+        else:
+            self.swap_archive_chunk = 100
+        # energy columns computed as soon as the replicas complete a cycle
+        if (self.keywords.get('EXCHANGE_PRECOMPUTE') is not None and
+            self.keywords.get('EXCHANGE_PRECOMPUTE').lower() == 'no'):
+            self.exchange_precompute = False
+        else:
+            self.exchange_precompute = True
+        # seed of the random number streams (see RandomStreams)
+        if self.keywords.get('RNG_SEED') is not None:
+            self.rng_seed = int(self.keywords.get('RNG_SEED'))
+        else:
+            self.rng_seed = None
 
         #examine RESOURCE_URL to see if it's remote (file staging)
 #        self.remote = self._check_remote_resource(self.keywords.get('RESOURCE_URL'))
@@ -198,7 +440,159 @@ class async_re_job(object):
             self.verbose = True
         else:
             self.verbose = False
+        # calibrate launch settings instead of running (see autotune())
+        if (self.keywords.get('AUTOTUNE') is not None and
+            self.keywords.get('AUTOTUNE').lower() == 'yes'):
+            self.autotune_mode = True
+        else:
+            self.autotune_mode = False
+        # grow and shrink the pilots with the backlog (see _adjustPilots())
+        if (self.keywords.get('ELASTIC') is not None and
+            self.keywords.get('ELASTIC').lower() == 'yes'):
+            self.elastic = True
+        else:
+            self.elastic = False
+        if self.keywords.get('ELASTIC_CORES') is not None:
+            self.elastic_cores = int(self.keywords.get('ELASTIC_CORES'))
+        else:
+            self.elastic_cores = self.pilot_specs[0]['TOTAL_CORES']
+        if self.keywords.get('ELASTIC_MAX_PILOTS') is not None:
+            self.elastic_max_pilots = int(self.keywords.get('ELASTIC_MAX_PILOTS'))
+        else:
+            self.elastic_max_pilots = 1
+        if self.keywords.get('ELASTIC_GROW_CHECKS') is not None:
+            self.elastic_grow_checks = int(
+                self.keywords.get('ELASTIC_GROW_CHECKS'))
+        else:
+            self.elastic_grow_checks = 3
+        if self.keywords.get('ELASTIC_SHRINK_CHECKS') is not None:
+            self.elastic_shrink_checks = int(
+                self.keywords.get('ELASTIC_SHRINK_CHECKS'))
+        else:
+            self.elastic_shrink_checks = 5
+
+    def _parsePilots(self):
+        """
+        Parse the pilot-jobs on which the replicas are run.
+
+        Each section of the command file which sets RESOURCE_URL describes a
+        pilot, for example an allocation on another partition or queue, with
+        its own PILOT_KEYWORDS settings; those not set in the section are
+        taken from the top level. Without such sections the top level
+        settings describe a single pilot. TOTAL_CORES is the sum of the cores
+        of all of the pilots.
+        """
+        names = [name for name in self.keywords.sections
+                 if self.keywords[name].get('RESOURCE_URL') is not None]
+        if len(names) == 0:
+            names = [None]
+        self.pilot_specs = []
+        for name in names:
+            spec = {'name': name}
+            for key in PILOT_KEYWORDS:
+                if name is not None and key in self.keywords[name]:
+                    spec[key] = self.keywords[name][key]
+                else:
+                    spec[key] = self.keywords.get(key)
+            if name is None:
+                spec['name'] = 'pilot'
+                where = ''
+            else:
+                where = ' (pilot %s)'%name
+            if spec['RESOURCE_URL'] is None:
+                self._exit('RESOURCE_URL needs to be specified')
+            # (not needed to run on the local backend)
+            if not spec['RESOURCE_URL'].startswith(
+                local_pilot.LOCAL_URL_PREFIX):
+                if spec['COORDINATION_URL'] is None:
+                    self._exit('COORDINATION_URL needs to be specified%s'%where)
+                if spec['QUEUE'] is None:
+                    self._exit('QUEUE needs to be specified%s'%where)
+            if spec['TOTAL_CORES'] is None:
+                self._exit('TOTAL_CORES needs to be specified%s'%where)
+            spec['TOTAL_CORES'] = int(spec['TOTAL_CORES'])
+            self.pilot_specs.append(spec)
+        self.total_cores = sum([spec['TOTAL_CORES']
+                                for spec in self.pilot_specs])
+
+    def _parseSubjobCores(self):
+        """
+        Parse the number of cores used by a replica in each state.
+
+        SUBJOB_CORES is either a single value, used for all states, or a comma
+        delimited list with one value per state. SUBJOB_CORES_FILE optionally
+        names a file of 'stateid cores' lines (such as an autotuned map) which
+        overrides SUBJOB_CORES for the states listed there.
+        """
+        subjob_cores = _split_keyword(self.keywords.get('SUBJOB_CORES'))
+        try:
+            self.subjob_cores = [int(cores) for cores in subjob_cores]
+        except ValueError:
+            self._exit('SUBJOB_CORES must be an integer or a list of integers')
+
+        self.subjob_cores_map = {}
+        cores_file = self.keywords.get('SUBJOB_CORES_FILE')
+        if cores_file is not None:
+            if not os.path.exists(cores_file):
+                self._exit('No such SUBJOB_CORES_FILE: %s'%cores_file)
+            for i,line in enumerate(_open(cores_file,'r')):
+                try:
+                    line = line[:line.index('#')] # ignore comments
+                except ValueError:
+                    pass
+                tokens = line.split()
+                if len(tokens) == 0:
+                    continue
+                try:
+                    sid,cores = int(tokens[0]),int(tokens[1])
+                except (ValueError,IndexError):
+                    self._exit('Bad state/cores specification on line %d of %s'
+                               %(i+1,cores_file))
+                self.subjob_cores_map[sid] = cores
+
+        # a replica runs on a single pilot
+        max_cores = max([spec['TOTAL_CORES'] for spec in self.pilot_specs])
+        for cores in self.subjob_cores + self.subjob_cores_map.values():
+            if not 0 < cores <= max_cores:
+                self._exit('The cores used by a replica (%d) must be between 1 '
+                           'and TOTAL_CORES (%d)'%(cores,max_cores))
+
+    def _stateCores(self, sid):
+        """Return the number of cores used by a replica in state sid."""
+        if self.subjob_cores_map.has_key(sid):
+            return self.subjob_cores_map[sid]
+        if len(self.subjob_cores) == 1:
+            return self.subjob_cores[0]
+        try:
+            return self.subjob_cores[sid]
+        except IndexError:
+            self._exit('SUBJOB_CORES lists %d values, but there is no value '
+                       'for state %d'%(len(self.subjob_cores),sid))
 
+    def _replicaCores(self, repl):
+        """Return the number of cores used by a replica in its current state.
+        """
+        return self._stateCores(self.status[repl]['stateid_current'])
+
+    def _affinityScript(self, ncores):
+        """
+        Return the lines of a bash run script which set PIN to the command
+        prefix that binds a replica using ncores cores to its cores. With
+        AFFINITY='core' the replica gets a block of ncores cores (and OpenMP
+        threads are placed one per core), with AFFINITY='socket' it gets the
+        whole socket holding that block. PIN is empty with AFFINITY='none' or
+        if no cores could be claimed, in which case the replica runs unbound.
+        """
+        if self.affinity == 'none':
+            return 'PIN=""\n'
+        script = AFFINITY_SCRIPT
+        for key,value in (('affinity',self.affinity),
+                          ('ncores',ncores),
+                          ('ppn',self.ppn),
+                          ('cores_per_socket',self.cores_per_socket),
+                          ('jobname',self.jobname)):
+            script = script.replace('@%s@'%key,str(value))
+        return script
 
     def _linkReplicaFile(self, link_filename, real_filename, repl):
         """
@@ -228,12 +622,25 @@ class async_re_job(object):
         engine input file for replica k. Also creates soft links to the working 
         directory for the accessory files specified in ENGINE_INPUT_EXTFILES.
         """
-	#pilotjob: Initialize PilotJob at given COORDINATION_URL (CU)
-        self.pj = PilotComputeService(self.keywords.get('COORDINATION_URL'))
-	#pilotjob: Initialize PilotJob Data service (DU)
-        self.cds=ComputeDataService()
-	#pilotjob: Launch the PilotJob at the given COORDINATION_URL
-        self.launch_pilotjob()
+        if len(self.subjob_cores) not in (1,self.nreplicas):
+            _exit('SUBJOB_CORES lists %d values, but there are %d states'
+                  %(len(self.subjob_cores),self.nreplicas))
+
+        self._startPools()
+
+	#pilotjob: Launch the PilotJob(s) at the given COORDINATION_URL(s)
+        if self.pilots is None:
+            self.launch_pilotjob()
+
+        # Calibration runs are set up in their own directories by autotune().
+        if self.autotune_mode:
+            return
+
+        # (only for MD engine modules computing one column at a time)
+        if (self.exchange_precompute and self.exchange_graph == 'all' and
+            self.__class__._energyColumn.im_func is not
+            async_re_job._energyColumn.im_func):
+            self._startColumnWorker()
 
         if (self.keywords.get('RE_SETUP') is not None and 
             self.keywords.get('RE_SETUP').lower() == 'yes'):
@@ -263,6 +670,18 @@ class async_re_job(object):
             self._read_status()
             self.updateStatus(restart=True)
 
+        if self.exchange_stats_interval > 0:
+            self.exchange_stats = ExchangeStatistics(self.nreplicas,
+                                                     self.nreplicas)
+            if (self.keywords.get('RE_SETUP') is None or
+                self.keywords.get('RE_SETUP').lower() != 'yes'):
+                self.exchange_stats.restore(self.basename)
+        if self.swap_archive_mode:
+            self.swap_archive = SwapMatrixArchive(self.basename,
+                                                  self.swap_archive_chunk,
+                                                  self.exchange_tolerance,
+                                                  self.exchange_exact_max)
+
 #        if self.remote:
 #            self._setup_remote_workdir()
 
@@ -273,10 +692,30 @@ class async_re_job(object):
                 _exit('Internal error after restart. Not all jobs are in wait '
                       'state.')
 
+    def _startPools(self):
+        """
+        Start the processes kept by the job for the whole run, which sample
+        the blocks of large exchanges. This must be done before the pilot(s)
+        or any thread are started, since forking a process with running
+        threads is unsafe (see setupJob() and multi_async_re).
+        """
+        if (self.exchange_block_size is not None and
+            self.exchange_graph == 'all' and not self.autotune_mode and
+            self.exchange_pool is None):
+            self.exchange_pool = Pool(processes=self.exchange_processes)
+
     def scheduleJobs(self):
-        # wait until bigjob enters executing
-        while self.pilotcompute.get_state() != 'Running':
-            time.sleep(10)
+        # use the time in the queue to get ready for the first cycle
+        if len(self._runningPilots()) == 0 and not self.autotune_mode:
+            self._prepareWhileQueued()
+        # wait until a bigjob enters executing
+        while len(self._runningPilots()) == 0:
+            time.sleep(1)
+
+        if self.autotune_mode:
+            self.autotune()
+            self.cleanJob()
+            return
 
         # Gets the wall clock time for a replica to complete a cycle
         # If unspecified it is estimated as 10% of job wall clock time
@@ -308,6 +747,7 @@ class async_re_job(object):
             self.launchJobs()
             self.updateStatus()
             self.print_status()        
+            self._adjustPilots((end_time - time.time())/60. + replica_run_time)
 
             time.sleep(cycle_time)
 
@@ -320,6 +760,36 @@ class async_re_job(object):
         self.waitJob()
         self.cleanJob()
 
+    def _prepareWhileQueued(self):
+        """
+        Do the work that would otherwise delay the first cycle while the
+        pilot(s) wait in the queue: the warm-up of the MD engine module (see
+        _warmUp()), a first round of exchanges among the replicas of a
+        restarted job and the submission of the first replicas, which start
+        as soon as a pilot does. (The replica directories and input files are
+        created by setupJob() once the pilots are submitted.)
+        """
+        start_time = time.time()
+        self._warmUp()
+        self.updateStatus()
+        self.doExchanges()
+        self.launchJobs()
+        self.updateStatus()
+        self.print_status()
+        print ('Prepared the first cycle in %.1f s while the pilot is queued'
+               %(time.time() - start_time))
+        sys.stdout.flush()
+
+    def _warmUp(self):
+        """
+        Prepare for the exchanges and launches of the first cycle while the
+        pilot is queued (see _prepareWhileQueued()). MD engine modules
+        override this to precompute data, such as the energy columns of the
+        replicas of a restarted job for the first exchange (see
+        _precomputeColumns()).
+        """
+        pass
+
     def waitJob(self):
         # cancel all not-running submitted subjobs
 #        for k in range(self.nreplicas):
@@ -331,31 +801,348 @@ class async_re_job(object):
 #        self.updateStatus()
 #        self.print_status()
         #wait until running jobs complete
-        self.cds.wait()
+        for pilot in self.pilots:
+            if pilot['phase'] == 'retired':
+                continue
+            if pilot['cds'] is None:
+                pilot['compute'].wait()
+            else:
+                pilot['cds'].wait()
 
     def cleanJob(self):
-        self.cds.cancel()
-        self.pj.cancel()
+        self._cancelPilots()
+        self.finalizeJob()
+
+    def finalizeJob(self):
+        """
+        Write the exchange statistics, the swap archive and the pilot file
+        and stop the exchange processes at the end of the run. Called by
+        cleanJob(), or for each of the jobs sharing the pilots once they are
+        canceled (see multi_async_re).
+        """
+        if self.exchange_stats is not None:
+            self.exchange_stats.flush(self.basename)
+        if self.swap_archive is not None:
+            self.swap_archive.flush()
+        if self.exchange_pool is not None:
+            self.exchange_pool.close()
+            self.exchange_pool.join()
+            self.exchange_pool = None
+        self._writePilotFile()
+
+    def _cancelPilots(self):
+        for pilot in self.pilots:
+            if pilot['phase'] != 'retired':
+                self._cancelPilot(pilot)
+
+    def _cancelPilot(self, pilot):
+        if pilot['service'] is None:
+            # reattached pilot (see _reattachPilots())
+            pilot['compute'].cancel()
+        else:
+            pilot['cds'].cancel()
+            pilot['service'].cancel()
+        pilot['phase'] = 'retired'
         
     def launch_pilotjob(self):
-	#pilotjob: PilotJob description
-	#pilotjob: Variables defined in command.inp
-        pcd = {'service_url': self.keywords.get('RESOURCE_URL'),
-               'number_of_processes': self.keywords.get('TOTAL_CORES'),
+        """
+        Launch a pilot-job for each of the pilots in the command file (see
+        _parsePilots()). self.pj, self.cds and self.pilotcompute refer to the
+        first pilot.
+
+        When restarting (RE_SETUP='no') the pilots of the previous run which
+        are still alive are reused instead, unless REUSE_PILOT='no' (see
+        _reattachPilots()).
+        """
+        self.pilots = []
+        if (not self.autotune_mode and
+            (self.keywords.get('RE_SETUP') is None or
+             self.keywords.get('RE_SETUP').lower() != 'yes') and
+            (self.keywords.get('REUSE_PILOT') is None or
+             self.keywords.get('REUSE_PILOT').lower() != 'no')):
+            self._reattachPilots()
+        if len(self.pilots) == 0:
+            for spec in self.pilot_specs:
+                self._createPilot(spec,int(self.keywords.get('WALL_TIME')))
+        self.pj = self.pilots[0]['service']
+        self.cds = self.pilots[0]['cds']
+        self.pilotcompute = self.pilots[0]['compute']
+        # pilot on which each replica was last launched
+        self.replica_pilot = {}
+        # consecutive checks with a high/low backlog (see _adjustPilots())
+        self.backlog = 0
+        self.backlog_high = 0
+        self.backlog_low = 0
+
+    def _createPilot(self, spec, walltime, elastic=False):
+        """
+        Launch a pilot-job with the settings in spec (see _parsePilots()) for
+        walltime minutes and add it to self.pilots, which holds for each
+        pilot its name, compute data service, compute service and pilot, its
+        cores, its measured cycle time (see _jobs_to_run()), whether it was
+        added by _adjustPilots(), its phase ('active', 'draining' or
+        'retired') and what is needed to reattach to it (see
+        _writePilotFile()).
+        """
+        if spec['RESOURCE_URL'].startswith(local_pilot.LOCAL_URL_PREFIX):
+            # run the replicas as local processes (see local_pilot)
+            pj = local_pilot.PilotComputeService()
+            cds = local_pilot.ComputeDataService()
+        else:
+            if PilotComputeService is None:
+                _exit('BigJob (the pilot module) is required for '
+                      'RESOURCE_URL %s'%spec['RESOURCE_URL'])
+            #pilotjob: Initialize PilotJob at given COORDINATION_URL (CU)
+            pj = PilotComputeService(spec['COORDINATION_URL'])
+            #pilotjob: Initialize PilotJob Data service (DU)
+            cds = ComputeDataService()
+        #pilotjob: PilotJob description
+        #pilotjob: Variables defined in command.inp
+        if spec['PPN'] is not None:
+            ppn = int(spec['PPN'])
+        else:
+            ppn = self.ppn
+        pcd = {'service_url': spec['RESOURCE_URL'],
+               'number_of_processes': spec['TOTAL_CORES'],
                'working_directory': self.bj_working_dir,
-               'queue': self.keywords.get('QUEUE'),
-               'processes_per_node': self.ppn,
-               'project': self.keywords.get('PROJECT'),
-               'walltime': int(self.keywords.get('WALL_TIME'))}
-
-        if self.keywords.get('SGE_WAYNESS') is not None:
-                pcd['spmd_variation'] = self.keywords.get('SGE_WAYNESS')
-         
-	#pilotjob: Create pilot job with above description
-        self.pj.create_pilot(pilot_compute_description=pcd)
-        self.cds.add_pilot_compute_service(self.pj)
-        self.pilotcompute = self.pj.list_pilots()[0]
-        
+               'queue': spec['QUEUE'],
+               'processes_per_node': ppn,
+               'project': spec['PROJECT'],
+               'walltime': walltime}
+
+        if spec['SGE_WAYNESS'] is not None:
+            pcd['spmd_variation'] = spec['SGE_WAYNESS']
+        if spec['LOCAL_QUEUE_WAIT'] is not None:
+            pcd['queue_wait'] = float(spec['LOCAL_QUEUE_WAIT'])
+
+        #pilotjob: Create pilot job with above description
+        pj.create_pilot(pilot_compute_description=pcd)
+        cds.add_pilot_compute_service(pj)
+        compute = pj.list_pilots()[0]
+        if hasattr(compute,'get_url'):
+            url = compute.get_url()
+        else:
+            # local pilots do not outlive the controller
+            url = None
+        self.pilots.append({'name': spec['name'],
+                            'cds': cds,
+                            'service': pj,
+                            'compute': compute,
+                            'cores': spec['TOTAL_CORES'],
+                            'cycle_time': None,
+                            'elastic': elastic,
+                            'phase': 'active',
+                            'url': url,
+                            'coordination_url': spec['COORDINATION_URL'],
+                            'walltime': walltime,
+                            'submit_time': time.time(),
+                            'start_time': None})
+        self._writePilotFile()
+        return len(self.pilots) - 1
+
+    def _writePilotFile(self):
+        """
+        Pickle what is needed to reattach to the live pilots (their URL,
+        cores, wall time and the times they were submitted and started
+        executing) to BASENAME.pilot.
+        """
+        saved = [dict([(key,pilot[key]) for key in
+                       ('name','url','coordination_url','cores','elastic',
+                        'walltime','submit_time','start_time')])
+                 for pilot in self.pilots
+                 if pilot['phase'] != 'retired' and pilot['url'] is not None]
+        f = _open(self.pilot_file,'w')
+        pickle.dump(saved,f)
+        f.close()
+
+    def _reattachPilots(self):
+        """
+        Reattach to the pilots of a previous run saved in BASENAME.pilot
+        which are still queued or executing and have enough wall time left to
+        run replicas (twice REPLICA_RUN_TIME). The compute units left over
+        from the previous run are canceled, since their replicas are
+        restarted. The wall time of the job is reduced to the longest time
+        left to the reattached pilots.
+        """
+        if not os.path.exists(self.pilot_file) or PilotCompute is None:
+            return
+        f = _open(self.pilot_file,'r')
+        saved = pickle.load(f)
+        f.close()
+        if self.keywords.get('REPLICA_RUN_TIME') is None:
+            min_walltime = 2*int(round(self.walltime/10.))
+        else:
+            min_walltime = 2*int(self.keywords.get('REPLICA_RUN_TIME'))
+        now = time.time()
+        walltime = 0.
+        for info in saved:
+            try:
+                #pilotjob: Reconnect to the PilotJob at its URL
+                compute = PilotCompute(pilot_url=info['url'])
+                state = compute.get_state()
+            except Exception, e:
+                print 'Warning: unable to reattach to pilot %s: %s'%(
+                    info['url'],e)
+                continue
+            if state in ('Done','Failed','Canceled'):
+                continue
+            start_time = info['start_time']
+            if start_time is None and state == 'Running':
+                # started while no controller was watching
+                start_time = info['submit_time']
+            if start_time is None:
+                remaining = info['walltime']
+            else:
+                remaining = info['walltime'] - (now - start_time)/60.
+            if remaining <= min_walltime:
+                continue
+            for cu in compute.list_compute_units():
+                if cu.get_state() not in ('Done','Failed','Canceled'):
+                    cu.cancel()
+            print ('Reattached to pilot %s (%s, %.0f minutes left)'
+                   %(info['name'],state,remaining))
+            pilot = dict(info)
+            pilot.update({'cds': None,
+                          'service': None,
+                          'compute': compute,
+                          'cycle_time': None,
+                          'phase': 'active',
+                          'start_time': start_time})
+            self.pilots.append(pilot)
+            walltime = max(walltime,remaining)
+        if len(self.pilots) > 0:
+            self.walltime = min(self.walltime,walltime)
+
+    def share_pilots(self, job):
+        """
+        Run the replicas of this job on the pilots of another job instead of
+        launching its own (to be called before setupJob()). The cores taken
+        by the replicas of each job sharing the pilots are accounted for by
+        all of them (see _jobs_to_run()).
+        """
+        self.pilots = job.pilots
+        self.pj = job.pj
+        self.cds = job.cds
+        self.pilotcompute = job.pilotcompute
+        self.replica_pilot = {}
+        self.backlog = 0
+        self.backlog_high = 0
+        self.backlog_low = 0
+        self.peer_jobs = [job] + job.peer_jobs
+        for peer in self.peer_jobs:
+            peer.peer_jobs.append(self)
+
+    def _runningPilots(self):
+        """
+        Return the indices of the pilots that are executing and accept
+        replicas (not being released by _adjustPilots()).
+        """
+        running = [p for p,pilot in enumerate(self.pilots)
+                   if pilot['phase'] == 'active' and
+                   pilot['compute'].get_state() == 'Running']
+        # record when the pilots start executing (see _reattachPilots())
+        started = [p for p in running if self.pilots[p]['start_time'] is None]
+        for p in started:
+            self.pilots[p]['start_time'] = time.time()
+        if len(started) > 0:
+            self._writePilotFile()
+        return running
+
+    def _adjustPilots(self, walltime):
+        """
+        With ELASTIC='yes', grow and shrink the pilots with the backlog of
+        waiting replicas. walltime is the time left to the job in minutes.
+
+        The backlog is high when, at the last launch, more replicas were left
+        waiting (besides the two kept for exchanges) than fit in the cores
+        of the running pilots, and low when none were left waiting and the
+        running replicas would fit without the last pilot added. After
+        ELASTIC_GROW_CHECKS consecutive high checks a pilot of ELASTIC_CORES
+        cores is requested for the rest of the job, up to ELASTIC_MAX_PILOTS
+        at a time and one at a time. After ELASTIC_SHRINK_CHECKS consecutive
+        low checks the last pilot added is drained, receiving no more
+        replicas, and it is canceled once its replicas have finished. The
+        checks are counted anew after each change, so that the pilots do not
+        thrash. When the pilots are shared by several jobs (see
+        share_pilots()), the replicas of all of them are counted.
+        """
+        if not self.elastic:
+            return
+        jobs = [self] + self.peer_jobs
+        running = [(job,k) for job in jobs for k in range(job.nreplicas)
+                   if job.status[k]['running_status'] == 'R']
+        # release the drained pilots
+        for p,pilot in enumerate(self.pilots):
+            if (pilot['phase'] == 'draining' and
+                not [k for job,k in running if job.replica_pilot.get(k) == p]):
+                print 'Releasing pilot %s'%pilot['name']
+                self._cancelPilot(pilot)
+                self._writePilotFile()
+
+        pilots = self._runningPilots()
+        cores = sum([self.pilots[p]['cores'] for p in pilots])
+        mean_cores = (sum([job._replicaCores(k) for job in jobs
+                           for k in range(job.nreplicas)])
+                      /float(sum([job.nreplicas for job in jobs])))
+        backlog = sum([job.backlog for job in jobs])
+        elastic = [p for p,pilot in enumerate(self.pilots)
+                   if pilot['elastic'] and pilot['phase'] == 'active']
+        if backlog > cores/mean_cores:
+            self.backlog_high += 1
+            self.backlog_low = 0
+        elif (backlog == 0 and elastic and elastic[-1] in pilots and
+              sum([job._replicaCores(k) for job,k in running]) <=
+              cores - self.pilots[elastic[-1]]['cores']):
+            self.backlog_low += 1
+            self.backlog_high = 0
+        else:
+            self.backlog_high = 0
+            self.backlog_low = 0
+        if self.verbose:
+            print ('backlog: %d replicas, %d pilot cores, high %d low %d'
+                   %(backlog,cores,self.backlog_high,self.backlog_low))
+
+        pending = [p for p in elastic if p not in pilots]
+        if (self.backlog_high >= self.elastic_grow_checks and
+            len(pending) == 0 and len(elastic) < self.elastic_max_pilots and
+            walltime > 1):
+            spec = dict(self.pilot_specs[0])
+            spec['TOTAL_CORES'] = self.elastic_cores
+            spec['name'] = 'elastic%d'%len(self.pilots)
+            print ('Requesting pilot %s with %d cores for %d minutes'
+                   %(spec['name'],self.elastic_cores,walltime))
+            self._createPilot(spec,int(walltime),elastic=True)
+            self.backlog_high = 0
+        elif self.backlog_low >= self.elastic_shrink_checks:
+            print 'Draining pilot %s'%self.pilots[elastic[-1]]['name']
+            self.pilots[elastic[-1]]['phase'] = 'draining'
+            self.backlog_low = 0
+
+    def _submitComputeUnit(self, repl, compute_unit_description):
+        """
+        Submit the compute unit of a replica to the pilot it was placed on
+        by launchJobs() (the first pilot if it was not placed) and return it.
+        """
+        pilot = self.pilots[self.replica_pilot.get(repl,0)]
+        return pilot['compute'].submit_compute_unit(compute_unit_description)
+
+    def _recordCycleTime(self, repl):
+        """
+        Update the mean cycle time of the pilot that ran the last cycle of a
+        replica, as an exponential moving average of the run times of the
+        compute units, if BigJob reports them.
+        """
+        details = self.cus[repl].get_details()
+        if not (details.has_key('start_time') and details.has_key('end_time')):
+            return
+        elapsed = float(details['end_time']) - float(details['start_time'])
+        pilot = self.pilots[self.replica_pilot.get(repl,0)]
+        if pilot['cycle_time'] is None:
+            pilot['cycle_time'] = elapsed
+        else:
+            pilot['cycle_time'] = 0.8*pilot['cycle_time'] + 0.2*elapsed
+
+
     def _write_status(self):
         """
         Pickle the current state of the RE job and write to in BASENAME.stat. 
@@ -364,6 +1151,10 @@ class async_re_job(object):
         f = _open(status_file,'w')
         pickle.dump(self.status,f)
         f.close()
+        # the random number streams, to continue them on restart
+        f = _open('%s.rng'%self.basename,'w')
+        pickle.dump(self.rng,f)
+        f.close()
 
     def _read_status(self):
         """
@@ -373,6 +1164,11 @@ class async_re_job(object):
         f = _open(status_file,'r')
         self.status = pickle.load(f)
         f.close()
+        rng_file = '%s.rng'%self.basename
+        if os.path.exists(rng_file):
+            f = _open(rng_file,'r')
+            self.rng = pickle.load(f)
+            f.close()
 
     def print_status(self):
         """
@@ -388,6 +1184,11 @@ class async_re_job(object):
                      self.status[k]['cycle_current']))                    
         log += 'Running = %d\n'%self.running
         log += 'Waiting = %d\n'%self.waiting
+        if len(self.pilots) > 1:
+            for pilot in self.pilots:
+                log += ('Pilot %s: %d cores, %s, %s\n'
+                        %(pilot['name'],pilot['cores'],pilot['phase'],
+                          pilot['compute'].get_state()))
 
         logfile = '%s_stat.txt'%self.basename
         ofile = _open(logfile,'w')
@@ -411,6 +1212,7 @@ class async_re_job(object):
             if self.status[replica]['running_status'] == 'R':
                 if self._hasCompleted(replica,this_cycle):
                     self.status[replica]['cycle_current'] += 1
+                    self._queueColumn(replica,this_cycle)
                 else:
                     print ('_updateStatus_replica(): Warning: restarting '
                            'replica %d (cycle %d)'%(replica,this_cycle))
@@ -422,6 +1224,8 @@ class async_re_job(object):
                     self.status[replica]['running_status'] = 'S'
                     if self._hasCompleted(replica,this_cycle):
                         self.status[replica]['cycle_current'] += 1
+                        self._recordCycleTime(replica)
+                        self._queueColumn(replica,this_cycle)
                     else:
                         print ('_updateStatus_replica(): Warning: restarting '
                                'replica %d (cycle %d)'%(replica,this_cycle))
@@ -477,47 +1281,313 @@ class async_re_job(object):
         else:
             return False
 
-    def _njobs_to_run(self):
-        # size of subjob buffer as a percentage of job slots 
-        # (TOTAL_CORES/SUBJOB_CORES)
+    def _jobs_to_run(self, candidates):
+        """
+        Return the replicas to launch, taken in order from the list of
+        waiting replicas in candidates, as (replica, pilot index) pairs.
+
+        Replicas are packed into a budget of cores for each pilot equal to
+        its TOTAL_CORES plus a buffer (SUBJOBS_BUFFER_SIZE, as a fraction of
+        TOTAL_CORES), less the cores of the replicas already submitted/running
+        on it. The cores used by a replica depend on its state (see
+        _stateCores()). Packing is first-fit: a replica needing more cores
+        than are left is skipped in favor of cheaper ones further down the
+        list. At least two replicas are always left in the waiting state so
+        that exchanges can take place. When the pilots are shared with other
+        jobs (see share_pilots()) the cores of their replicas are taken off
+        the budgets and the replicas of this job are packed into core_budget
+        cores, if set, as well.
+
+        With several pilots, only those executing are used (all of them if
+        none is) and each replica goes to the fastest pilot with room for it,
+        as measured by its mean cycle time (see _recordCycleTime()). Pilots
+        not yet measured are tried first. Since the state of a replica is
+        kept in files, it may run each cycle on a different pilot.
+        """
+        # size of subjob buffer as a percentage of TOTAL_CORES
         subjobs_buffer_size = self.keywords.get('SUBJOBS_BUFFER_SIZE')
         if subjobs_buffer_size is None:
             subjobs_buffer_size = 0.5
         else:
             subjobs_buffer_size = float(subjobs_buffer_size)
-        # launch new replicas if the number of submitted/running subjobs is 
-        # less than the number of available slots 
-        # (total_cores/subjob_cores) + 50%
-        available_slots = (int(self.keywords.get('TOTAL_CORES')) / 
-                           int(self.keywords.get('SUBJOB_CORES')))
-        max_njobs_submitted = int((1.+subjobs_buffer_size)*available_slots)
-        nlaunch = self.waiting - max(2,self.nreplicas - max_njobs_submitted)
-        nlaunch = max(0,nlaunch)
+        pilots = self._runningPilots()
+        if len(pilots) == 0:
+            pilots = [p for p,pilot in enumerate(self.pilots)
+                      if pilot['phase'] == 'active']
+        if len(pilots) == 0:
+            # (all of the pilots retired or being released)
+            return []
+        running = [k for k in range(self.nreplicas)
+                   if self.status[k]['running_status'] == 'R']
+        free_cores = {}
+        for p in pilots:
+            free_cores[p] = int((1.+subjobs_buffer_size)*
+                                self.pilots[p]['cores'])
+        for k in running:
+            p = self.replica_pilot.get(k,0)
+            if free_cores.has_key(p):
+                free_cores[p] -= self._replicaCores(k)
+        for job in self.peer_jobs:
+            for k in range(job.nreplicas):
+                p = job.replica_pilot.get(k,0)
+                if (job.status[k]['running_status'] == 'R' and
+                    free_cores.has_key(p)):
+                    free_cores[p] -= job._replicaCores(k)
+        if self.core_budget is not None:
+            job_free_cores = (self.core_budget -
+                              sum([self._replicaCores(k) for k in running]))
+        else:
+            job_free_cores = sum(free_cores.values())
+        # fastest first, unmeasured pilots before measured ones
+        def _cycle_time(p):
+            if self.pilots[p]['cycle_time'] is None:
+                return 0.
+            return self.pilots[p]['cycle_time']
+        max_nlaunch = len(candidates) - 2
+
+        launch = []
+        for k in candidates:
+            if (len(launch) >= max_nlaunch or max(free_cores.values()) <= 0
+                or job_free_cores <= 0):
+                break
+            cores = self._replicaCores(k)
+            fits = [p for p in pilots if cores <= free_cores[p]]
+            if len(fits) > 0 and cores <= job_free_cores:
+                p = min(fits,key=lambda p: (_cycle_time(p),-free_cores[p]))
+                launch.append((k,p))
+                free_cores[p] -= cores
+                job_free_cores -= cores
         if self.verbose:
-            print 'available_slots: %d'%available_slots
-            print 'max_njobs_submitted: %d'%max_njobs_submitted
-            print 'running/submitted subjobs: %d'%self.running
-            print 'waiting replicas: %d'%self.waiting
-            print 'replicas to launch: %d'%nlaunch
-        return nlaunch
+            cores_submitted = sum([self._replicaCores(k) for k in running])
+            print 'max_cores_submitted: %d'%(
+                int((1.+subjobs_buffer_size)*self.total_cores))
+            print 'running/submitted subjobs: %d (%d cores)'%(len(running),
+                                                              cores_submitted)
+            print 'waiting replicas: %d'%len(candidates)
+            print 'replicas to launch: %d (%d cores)'%(
+                len(launch),sum([self._replicaCores(k) for k,p in launch]))
+            if len(self.pilots) > 1:
+                for p in pilots:
+                    print ('pilot %s: %d free cores, cycle time %s'
+                           %(self.pilots[p]['name'],free_cores[p],
+                             self.pilots[p]['cycle_time']))
+        return launch
 
     def launchJobs(self):
         """
-        Scan the replicas in wait state and randomly launch some of them if 
+        Scan the replicas in wait state and randomly launch some of them if
         CPU's are available.
-        """ 
-        jobs_to_launch = self._njobs_to_run()
-        if jobs_to_launch > 0:
-            wait = self.replicas_waiting
-            random.shuffle(wait)
-            n = min(jobs_to_launch,len(wait))
-            for k in wait[0:n]:
-                if self.verbose:
-                    print ('Launching replica %d cycle %d'
-                           %(k,self.status[k]['cycle_current']))
-                self.cus[k] = (
-                    self._launchReplica(k,self.status[k]['cycle_current']))
-                self.status[k]['running_status'] = 'R'
+        """
+        wait = self.replicas_waiting
+        self.rng.stream('launch').shuffle(wait)
+        launch = self._jobs_to_run(wait)
+        # replicas left waiting for cores, besides the two kept for exchanges
+        self.backlog = max(len(wait) - len(launch) - 2,0)
+        for k,p in launch:
+            if self.verbose:
+                print ('Launching replica %d cycle %d'
+                       %(k,self.status[k]['cycle_current']))
+            self.replica_pilot[k] = p
+            self.cus[k] = (
+                self._launchReplica(k,self.status[k]['cycle_current']))
+            self.status[k]['running_status'] = 'R'
+
+    def _stateCoordinates(self):
+        """
+        Return the coordinates of each state in parameter space (e.g. its
+        lambda and temperature), as a list of lists, from which the graph of
+        neighbor states of EXCHANGE_GRAPH is built, or None if the states
+        have no such coordinates. MD engine modules override this.
+        """
+        return None
+
+    def _reducedEnergies(self, repl, states):
+        """
+        Return the reduced energies of replica repl (at its current cycle)
+        in each of the given states, or None if the energies can only be
+        computed all at once by _computeSwapMatrix(). MD engine modules
+        override this to let exchanges on a graph of states (EXCHANGE_GRAPH)
+        compute only the energies they need.
+        """
+        return None
+
+    def _energyColumn(self, repl, cyc):
+        """
+        Return the reduced energies of replica repl at the end of cycle cyc
+        in all of the states, or None if they can only be computed by
+        _computeSwapMatrix(). MD engine modules override this. It may be
+        called from the background thread of _startColumnWorker().
+        """
+        return None
+
+    def _energyMatrix(self):
+        """
+        Return (and allocate) the numpy array of the energies of the replicas
+        in the states, U[state,replica], in which their columns are cached
+        (see _cachedSwapMatrix()). MD engine modules computing the columns in
+        other processes override this to place it in shared memory.
+        """
+        if self.energy_matrix is None:
+            self.energy_matrix = zeros((self.nreplicas,self.nreplicas))
+        return self.energy_matrix
+
+    def _computeEnergyColumns(self, replicas):
+        """
+        Compute the reduced energies of each of the given replicas (at their
+        current cycles) in all of the states into their columns of
+        _energyMatrix() and return True, or return False if they can only be
+        computed by _computeSwapMatrix(). They come from _energyColumn() by
+        default; MD engine modules can override this to compute many columns
+        at once.
+        """
+        U = self._energyMatrix()
+        for repl in replicas:
+            column = self._energyColumn(repl,self.status[repl]['cycle_current'])
+            if column is None:
+                return False
+            U[:,repl] = column
+        return True
+
+    def _startColumnWorker(self):
+        """
+        Start a background thread computing the energy column of each
+        replica as soon as it completes a cycle (see _queueColumn()), so that
+        exchanges mostly assemble columns already in the cache.
+        """
+        self._energyMatrix()
+        self.column_queue = Queue.Queue()
+        self.column_lock = threading.Lock()
+        self.column_warned = False
+        thread = threading.Thread(target=self._columnWorker)
+        thread.daemon = True
+        thread.start()
+
+    def _queueColumn(self, repl, cyc):
+        if self.column_queue is not None:
+            self.column_queue.put((repl,cyc))
+
+    def _columnWorker(self):
+        while True:
+            repl,cyc = self.column_queue.get()
+            try:
+                column = self._energyColumn(repl,cyc)
+            except (IOError,OSError,ValueError,IndexError):
+                # (output not readable yet: computed again by the exchange,
+                # which reports any error)
+                column = None
+            except Exception, e:
+                # (anything else is a bug: every column then falls back to
+                # the exchange, so say so once)
+                if not self.column_warned:
+                    print ('_columnWorker(): Warning: unable to compute the '
+                           'energies of replica %d at cycle %d, leaving them '
+                           'to the exchanges: %s: %s'%(
+                            repl,cyc,e.__class__.__name__,e))
+                    self.column_warned = True
+                column = None
+            if column is not None:
+                self.column_lock.acquire()
+                if self.energy_cycles.get(repl,-1) < cyc:
+                    self.energy_matrix[:,repl] = column
+                    self.energy_cycles[repl] = cyc
+                self.column_lock.release()
+            self.column_queue.task_done()
+
+    def _cachedSwapMatrix(self, replicas, states):
+        """
+        Return the swap matrix (see _computeSwapMatrix()), computing only the
+        energy columns of the replicas which completed a cycle since they
+        were last exchanged and whose columns were not computed in the
+        background (see _computeEnergyColumns() and _startColumnWorker()).
+        Falls back to _computeSwapMatrix() if the columns cannot be computed
+        separately. The matrix returned is _energyMatrix() itself, not a
+        copy; ExchangeSampler copies the energies of the waiting replicas out
+        of it into its own array (one numpy gather), so that the cache is
+        left as is by the sampling.
+        """
+        if self.column_queue is not None:
+            # wait for the columns being computed in the background
+            self.column_queue.join()
+        new = [repl for repl in replicas
+               if (self.energy_cycles.get(repl) !=
+                   self.status[repl]['cycle_current'])]
+        if len(new) > 0:
+            if not self._computeEnergyColumns(new):
+                return self._computeSwapMatrix(replicas,states)
+            for repl in new:
+                self.energy_cycles[repl] = self.status[repl]['cycle_current']
+        print ('Swap matrix columns computed at exchange: %d of %d'
+               %(len(new),len(replicas)))
+        return self._energyMatrix()
+
+    def _precomputeColumns(self):
+        """
+        Compute the energy columns of the replicas of a restarted job which
+        are waiting to exchange, at the last cycle they completed, into the
+        cache of _cachedSwapMatrix() (see _warmUp()). Return the number of
+        columns computed.
+        """
+        if self.exchange_graph != 'all':
+            return 0
+        if self.column_queue is not None:
+            # (columns of the replicas completed while ASyncRE was down)
+            self.column_queue.join()
+        replicas = [k for k in self.replicas_waiting_to_exchange
+                    if (self.energy_cycles.get(k) !=
+                        self.status[k]['cycle_current'] - 1)]
+        if len(replicas) == 0:
+            return 0
+        # the cycles the replicas are exchanged at (see doExchanges())
+        for k in replicas:
+            self.status[k]['cycle_current'] -= 1
+        try:
+            if not self._computeEnergyColumns(replicas):
+                return 0
+            for k in replicas:
+                self.energy_cycles[k] = self.status[k]['cycle_current']
+        finally:
+            for k in replicas:
+                self.status[k]['cycle_current'] += 1
+        print 'Swap matrix columns computed while queued: %d'%len(replicas)
+        return len(replicas)
+
+    def _stateNeighbors(self):
+        """
+        Return (and cache) the neighbors of each state on the EXCHANGE_GRAPH
+        graph, as a list of lists of state ids.
+        """
+        if self.state_neighbors is None:
+            coordinates = self._stateCoordinates()
+            if coordinates is None:
+                self._exit('EXCHANGE_GRAPH = %s is not supported by RE_TYPE '
+                           '%s'%(self.exchange_graph,
+                                 self.keywords.get('RE_TYPE')))
+            if self.exchange_graph == 'grid':
+                self.state_neighbors = grid_neighbors(coordinates)
+            else:
+                k = self.exchange_neighbors
+                if k is None:
+                    k = 2*len(coordinates[0])
+                self.state_neighbors = knn_neighbors(coordinates,k)
+        return self.state_neighbors
+
+    def _computeNeighborSwapMatrix(self, replicas, states, neighbors):
+        """
+        Return the energies of each replica in its state and in the
+        neighbors of its state (given as positions in states) as a dict,
+        U[(state_id, replica)], the other entries of the swap matrix being
+        left out (see ExchangeSampler). Falls back to the full swap matrix
+        (see _computeSwapMatrix()) if _reducedEnergies() is not implemented.
+        """
+        U = {}
+        for i,repl in enumerate(replicas):
+            sids = [states[i]] + [states[a] for a in neighbors[i]]
+            energies = self._reducedEnergies(repl,sids)
+            if energies is None:
+                return self._computeSwapMatrix(replicas,states)
+            for sid,u in zip(sids,energies):
+                U[(sid,repl)] = u
+        return U
 
     def doExchanges(self):
         """Perform exchanges among waiting replicas using Gibbs sampling."""
@@ -529,6 +1599,14 @@ class async_re_job(object):
         nreplicas_to_exchange = len(replicas_to_exchange)
         if nreplicas_to_exchange < 2:
             return 0
+        # skip the exchange if no replica completed a cycle since the last one
+        waiting = [(k,self.status[k]['cycle_current'])
+                   for k in replicas_to_exchange]
+        if waiting == self.last_exchange:
+            if self.verbose:
+                print 'No new replicas to exchange'
+            return 0
+        self.last_exchange = waiting
 
         print 'Initiating exchanges amongst %d replicas:'%nreplicas_to_exchange
         exchange_start_time = time.time()
@@ -540,8 +1618,22 @@ class async_re_job(object):
         # The computeSwapMatrix() function is defined by application 
         # classes (Amber/US, Impact/BEDAM, etc.)
         matrix_start_time = time.time()
-        swap_matrix = self._computeSwapMatrix(replicas_to_exchange,
-                                              states_to_exchange)
+        if self.exchange_graph == 'all':
+            neighbors = None
+            swap_matrix = self._cachedSwapMatrix(replicas_to_exchange,
+                                                 states_to_exchange)
+        else:
+            # exchanges only between neighbor states: the other energies
+            # are computed by the sampler if and when they are needed
+            state_neighbors = self._stateNeighbors()
+            positions = dict([(sid,a) for a,sid in
+                              enumerate(states_to_exchange)])
+            neighbors = [[positions[nid] for nid in state_neighbors[sid]
+                          if positions.has_key(nid)]
+                         for sid in states_to_exchange]
+            swap_matrix = self._computeNeighborSwapMatrix(replicas_to_exchange,
+                                                          states_to_exchange,
+                                                          neighbors)
         matrix_time = time.time() - matrix_start_time
 
         sampling_start_time = time.time()
@@ -550,28 +1642,105 @@ class async_re_job(object):
             mreps = self.nexchg_rounds
         else:
             mreps = nreplicas_to_exchange**(-self.nexchg_rounds)
-        for reps in range(mreps):
-            for repl_i in replicas_to_exchange:
-                sid_i = self.status[repl_i]['stateid_current'] 
-                curr_states = [self.status[repl_j]['stateid_current'] 
-                               for repl_j in replicas_to_exchange]
-                repl_j = pairwise_independence_sampling(repl_i,sid_i,
-                                                        replicas_to_exchange,
-                                                        curr_states,
-                                                        swap_matrix)
-                if repl_j != repl_i:
-                    sid_i = self.status[repl_i]['stateid_current'] 
-                    sid_j = self.status[repl_j]['stateid_current']
-                    self.status[repl_i]['stateid_current'] = sid_j
-                    self.status[repl_j]['stateid_current'] = sid_i
+        sampler = ExchangeSampler(replicas_to_exchange,states_to_exchange,
+                                  swap_matrix,neighbors,self._reducedEnergies,
+                                  self.rng.stream('exchange'))
+        if self.exchange_stats is not None:
+            sampler.track_transitions()
+        rng_state = self.rng.stream('exchange').get_state()
+        # (blocks cannot reach all of the permutations if some swaps are
+        # excluded by energies infinite or not computed, see ExchangeSampler)
+        blocks = (neighbors is None and self.nexchg_rounds != 0 and
+                  self.exchange_block_size is not None and
+                  nreplicas_to_exchange > self.exchange_block_size and
+                  isfinite(sampler.W).all())
+        exact = (neighbors is None and self.nexchg_rounds != 0 and
+                 not blocks and
+                 nreplicas_to_exchange <= self.exchange_exact_max)
+        tau = None
+        if blocks:
+            method = 'blocks'
+            # independent chains on blocks of states, in parallel
+            if self.nexchg_rounds < 0:
+                mreps = self.exchange_block_size**(-self.nexchg_rounds)
+            nblocks,nsweeps = sampler.block_sample(self.exchange_block_size,
+                                                   self.exchange_block_offset,
+                                                   self.exchange_pool,mreps,
+                                                   self.exchange_exact_max,
+                                                   self.exchange_tolerance,
+                                                   self.exchange_time_budget)
+            if self.exchange_block_offset == 0:
+                self.exchange_block_offset = self.exchange_block_size/2
+            else:
+                self.exchange_block_offset = 0
+        elif exact:
+            method = 'exact'
+            # few replicas: draw from the exact distribution, no sweeps
+            sampler.exact_sample()
+            nsweeps = 0
+        elif self.exchange_tolerance is not None:
+            method = 'tolerance'
+            # as many sweeps as needed to mix, at most NEXCHG_ROUNDS if set
+            if self.keywords.get('NEXCHG_ROUNDS') is not None:
+                max_sweeps = mreps
+            else:
+                max_sweeps = None
+            nsweeps,tau = sampler.sweep_to_tolerance(self.exchange_tolerance,
+                                                     max_sweeps,
+                                                     self.exchange_time_budget)
+        elif self.nexchg_rounds >= 0 and neighbors is None:
+            method = 'sweep'
+            sampler.sweep(mreps)
+            nsweeps = mreps
+        else:
+            method = 'metropolis'
+            # n**k sweeps, or sweeps on a graph: cheap O(1) visits, within
+            # the time budget
+            nsweeps = sampler.metropolis_sweep(mreps,self.exchange_time_budget)
+        for repl,sid in zip(replicas_to_exchange,sampler.current_states()):
+            self.status[repl]['stateid_current'] = sid
+        if self.exchange_stats is not None:
+            self.exchange_stats.record(sampler,
+                                       [self.status[k]['stateid_current']
+                                        for k in range(self.nreplicas)],
+                                       time.time())
+            if (len(self.exchange_stats.exchange_times) %
+                self.exchange_stats_interval == 0):
+                self.exchange_stats.flush(self.basename)
+        if self.swap_archive is not None:
+            self.swap_archive.append(sampler,rng_state,method,nsweeps,
+                                     time.time())
 
         # Uncomment to debug Gibbs sampling: 
         # Actual and observed populations of state permutations should match.
+        # (exchange_validation.py does the same check much faster, offline.)
         # 
         #     self._debug_collect_state_populations(replicas_to_exchange)
         # self._debug_validate_state_populations(replicas_to_exchange,
         #                                        states_to_exchange,U)
         sampling_time = time.time() - sampling_start_time
+        if sampling_time > 0.:
+            sweep_rate = nsweeps/sampling_time
+        else:
+            sweep_rate = 0.
+        if blocks and nsweeps == 0:
+            print ('Gibbs sampling: %d blocks on %d processes, exact draws'
+                   %(nblocks,self.exchange_processes))
+        elif blocks:
+            print ('Gibbs sampling: %d blocks on %d processes, %d sweeps, '
+                   '%.0f sweeps/s'%(nblocks,self.exchange_processes,nsweeps,
+                                    sweep_rate))
+        elif exact:
+            print 'Gibbs sampling: exact draw'
+        elif tau is not None:
+            print ('Gibbs sampling: %d sweeps, %.0f sweeps/s, energy '
+                   'autocorrelation time %.1f sweeps'%(nsweeps,sweep_rate,tau))
+        else:
+            print ('Gibbs sampling: %d of %d sweeps, %.0f sweeps/s'
+                   %(nsweeps,mreps,sweep_rate))
+        if neighbors is not None:
+            print ('Swap matrix entries computed: %d of %d'
+                   %(sampler.computed_entries(),nreplicas_to_exchange**2))
         # Write new input files.
         for k in replicas_to_exchange:
             # Create new input files for the next cycle and place replicas back
@@ -588,6 +1757,188 @@ class async_re_job(object):
         print '------------------------------------------'
         print 'Total exchange time         : %10.2f s'%total_time
 
+    def autotune(self):
+        """
+        Calibrate the launch settings (cores, threads, executables, etc.) by
+        running short calibration cycles of the real input with each of the
+        configurations returned by _autotuneTrials().
+
+        Each configuration is run in a scratch directory autotune/trialN that
+        links to the files in the working directory. As many replicas as fit
+        in TOTAL_CORES run AUTOTUNE_CYCLES cycles each (without exchanges) and
+        the throughput is measured in replica-cycles per hour per node (of PPN
+        cores). The best configuration is written back as keywords to a copy
+        of the command file, <command_file>_autotuned, for the production run.
+        """
+        basedir = os.getcwd()
+        tunedir = os.path.join(basedir,'autotune')
+        if os.path.exists(tunedir):
+            _exit('Autotune directory already exists. Remove it first.')
+        os.mkdir(tunedir)
+        if self.keywords.get('AUTOTUNE_CYCLES') is not None:
+            ncycles = int(self.keywords.get('AUTOTUNE_CYCLES'))
+        else:
+            ncycles = 1
+
+        trials = self._autotuneTrials()
+        saved_keywords = self.keywords.dict()
+        results = []
+        for n,trial in enumerate(trials):
+            trialdir = os.path.join(tunedir,'trial%d'%n)
+            os.mkdir(trialdir)
+            for name in os.listdir(basedir):
+                if name == 'autotune' or re.match('r\d+$',name):
+                    continue
+                os.symlink(os.path.join(basedir,name),
+                           os.path.join(trialdir,name))
+            print 'Autotune trial %d of %d: %s'%(n+1,len(trials),trial)
+            sys.stdout.flush()
+            os.chdir(trialdir)
+            try:
+                rate = self._runAutotuneTrial(trial,ncycles)
+            finally:
+                os.chdir(basedir)
+                self.keywords.clear()
+                self.keywords.update(saved_keywords)
+            results.append((rate,n))
+        self._checkInput()
+
+        report = '%6s %12s  %s\n'%('trial','cycles/h/node','settings')
+        for rate,n in results:
+            report += '%6d %12.2f  %s\n'%(n,rate,trials[n])
+        best_rate,best = max(results)
+        report += 'Best: trial %d\n'%best
+        # throughput gained by binding replicas to cores
+        for rate,n in results:
+            if trials[n].get('AFFINITY','none') == 'none':
+                continue
+            unbound = dict(trials[n],AFFINITY='none')
+            for rate0,m in results:
+                if trials[m] == unbound and rate0 > 0.:
+                    report += ('AFFINITY=%s vs none (trial %d vs %d): '
+                               '%+.1f%%\n'%(trials[n]['AFFINITY'],n,m,
+                                            100.*(rate/rate0-1.)))
+        print report
+        ofile = _open(os.path.join(tunedir,'autotune.txt'),'w')
+        ofile.write(report)
+        ofile.close()
+        if best_rate <= 0.:
+            _exit('Autotune: no configuration completed its calibration '
+                  'cycles.')
+
+        # Write the best configuration back as keywords.
+        keywords = ConfigObj(self.command_file)
+        for key,value in trials[best].iteritems():
+            keywords[key] = value
+        if keywords.has_key('SUBJOB_CORES_FILE'):
+            del keywords['SUBJOB_CORES_FILE']
+        keywords['AUTOTUNE'] = 'no'
+        root,ext = os.path.splitext(self.command_file)
+        keywords.filename = '%s_autotuned%s'%(root,ext)
+        keywords.write()
+        print 'Autotuned settings written to %s'%keywords.filename
+
+    def _autotuneTrials(self):
+        """
+        Return the launch configurations to calibrate, each as a dict of
+        keyword settings. The core module varies the cores per replica
+        (AUTOTUNE_CORES), the threads per replica (AUTOTUNE_THREADS,
+        OMP_NUM_THREADS) and the binding of replicas to cores
+        (AUTOTUNE_AFFINITY, AFFINITY). MD engine modules may extend these,
+        for example with a choice of executables.
+        """
+        if self.keywords.get('AUTOTUNE_CORES') is not None:
+            cores = [int(c) for c in
+                     _split_keyword(self.keywords.get('AUTOTUNE_CORES'))]
+        else:
+            cores = [self._stateCores(0)]
+        if self.keywords.get('AUTOTUNE_THREADS') is not None:
+            threads = [int(t) for t in
+                       _split_keyword(self.keywords.get('AUTOTUNE_THREADS'))]
+        else:
+            threads = [None]
+        trials = []
+        for ncores in cores:
+            for nthreads in threads:
+                trial = {'SUBJOB_CORES': str(ncores)}
+                if nthreads is not None:
+                    # more threads than cores only oversubscribes the cores
+                    if nthreads > ncores:
+                        continue
+                    trial['OMP_NUM_THREADS'] = str(nthreads)
+                trials.append(trial)
+        if self.keywords.get('AUTOTUNE_AFFINITY') is not None:
+            affinities = [a.strip().lower() for a in
+                          _split_keyword(self.keywords.get('AUTOTUNE_AFFINITY'))]
+            trials = [dict(trial,AFFINITY=affinity) for trial in trials
+                      for affinity in affinities]
+        return trials
+
+    def _runAutotuneTrial(self, trial, ncycles):
+        """
+        Run ncycles calibration cycles of as many replicas as fit in
+        TOTAL_CORES with the keyword settings in trial (in the current
+        directory) and return the throughput in replica-cycles per hour per
+        node. A configuration that fails scores zero.
+        """
+        for key,value in trial.iteritems():
+            self.keywords[key] = value
+        if self.keywords.has_key('SUBJOB_CORES_FILE'):
+            del self.keywords['SUBJOB_CORES_FILE']
+        try:
+            self._checkInput()
+        except SystemExit:
+            print 'Autotune: invalid settings, skipping.'
+            return 0.
+        cores = self._stateCores(0)
+        # (the calibration runs on the first pilot)
+        self.replica_pilot = {}
+        replicas = range(min(self.nreplicas,self.pilots[0]['cores']/cores))
+
+        self.status = [{'stateid_current': k, 'running_status': 'W',
+                        'cycle_current': 1} for k in range(self.nreplicas)]
+        for k in replicas:
+            os.mkdir('r%d'%k)
+            if self.extfiles is not None:
+                for file in self.extfiles:
+                    self._linkReplicaFile(file,file,k)
+            self._buildInpFile(k)
+
+        start_time = time.time()
+        for k in replicas:
+            self.cus[k] = self._launchReplica(k,1)
+            self.status[k]['running_status'] = 'R'
+        completed = 0
+        failed = False
+        while not failed and completed < ncycles*len(replicas):
+            time.sleep(1)
+            for k in replicas:
+                if self.status[k]['running_status'] != 'R':
+                    continue
+                cycle = self.status[k]['cycle_current']
+                if not self._isDone(k,cycle):
+                    continue
+                self._updateStatus_replica(k,False)
+                if self.status[k]['cycle_current'] == cycle:
+                    failed = True
+                    break
+                completed += 1
+                if cycle < ncycles:
+                    self.cus[k] = self._launchReplica(k,cycle+1)
+                    self.status[k]['running_status'] = 'R'
+        elapsed = time.time() - start_time
+        if failed:
+            print 'Autotune: replica %d failed, skipping.'%k
+            for k in replicas:
+                if self.status[k]['running_status'] == 'R':
+                    self.cus[k].cancel()
+            return 0.
+        nodes = float(len(replicas)*cores)/self.ppn
+        rate = completed/(elapsed/3600.)/nodes
+        print ('Autotune: %d replica-cycles in %.1f s on %.2f node(s), '
+               '%.2f replica-cycles/hour/node'%(completed,elapsed,nodes,rate))
+        return rate
+
 
 
 #     def _check_remote_resource(self, resource_url):
@@ -0,0 +1,266 @@
+"""
+Archive of the exchanges of an asynchronous RE job and offline replay
+
+SwapMatrixArchive appends each exchange to chunked numpy archives,
+BASENAME_swap_00000.npz, BASENAME_swap_00001.npz, etc., each holding up to
+chunk_size exchanges with, for exchange k of the chunk:
+
+k_replicas, k_states   the waiting replicas and their states before the
+                       exchange
+k_W                    the swap matrix of the waiting replicas,
+                       W[a,i] = U[states[a]][replicas[i]] (NaN where not
+                       computed)
+k_perm                 the resulting permutation (replica i ending up in
+                       state states[perm[i]])
+k_rng_keys, k_rng_pos, k_rng_gauss
+                       the state of the exchange random number stream
+                       before the exchange
+k_neighbors, k_neighbor_offsets
+                       the graph of neighbor states, if any (the neighbors
+                       of position a are neighbors[offsets[a]:offsets[a+1]])
+k_method, k_nsweeps, k_time
+                       the sampling method, the number of sweeps done and
+                       the time of the exchange
+
+and the settings of the run in effect for all of the exchanges of the chunk:
+
+tolerance              the EXCHANGE_TOLERANCE of the 'tolerance' method
+                       (NaN if not set)
+exact_max              the largest number of replicas drawn exactly
+                       (EXCHANGE_EXACT_MAX)
+
+read_swap_archive() iterates over the archived exchanges, e.g. for
+reweighting analyses. Run as a script, this module replays the archived
+exchanges with the samplers of gibbs_sampling, without any MD, to validate
+and benchmark them on production data:
+
+python swap_archive.py [options] BASENAME
+"""
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+from numpy import asarray, array, int32, uint32, float64, isnan, savez, load
+from numpy.random import RandomState
+
+from gibbs_sampling import ExchangeSampler, EXACT_SAMPLING_MAX
+
+__all__ = ['SwapMatrixArchive', 'read_swap_archive', 'replay_exchange',
+           'REPLAY_METHODS']
+
+# sampling methods that can be replayed (see replay_exchange())
+REPLAY_METHODS = ('archived', 'exact', 'sweep', 'metropolis', 'tolerance')
+
+def _chunk_files(basename):
+    """Return the archive files of basename, in order."""
+    dirname = os.path.dirname(basename) or '.'
+    pattern = re.compile(re.escape(os.path.basename(basename)) +
+                         r'_swap_(\d+)\.npz$')
+    chunks = []
+    for name in os.listdir(dirname):
+        m = pattern.match(name)
+        if m:
+            chunks.append((int(m.group(1)),os.path.join(dirname,name)))
+    return [name for n,name in sorted(chunks)]
+
+class SwapMatrixArchive(object):
+    """
+    Append exchanges to the chunked archive of basename, done with the
+    given EXCHANGE_TOLERANCE (None if not set) and EXCHANGE_EXACT_MAX.
+    """
+    def __init__(self, basename, chunk_size=100, tolerance=None,
+                 exact_max=EXACT_SAMPLING_MAX):
+        self.basename = basename
+        self.chunk_size = chunk_size
+        self.tolerance = tolerance
+        self.exact_max = exact_max
+        # continue after the chunks of previous runs
+        self.nchunks = len(_chunk_files(basename))
+        self.events = {}
+        self.nevents = 0
+
+    def append(self, sampler, rng_state, method, nsweeps, t):
+        """
+        Archive the exchange done by sampler (an ExchangeSampler, at the end
+        of the exchange), rng_state being the state of its random number
+        stream before the exchange (from RandomState.get_state()).
+        """
+        k = self.nevents
+        events = self.events
+        events['%d_replicas'%k] = asarray(sampler.replicas,dtype=int32)
+        events['%d_states'%k] = asarray(sampler.states,dtype=int32)
+        events['%d_W'%k] = array(sampler.W,dtype=float64)
+        events['%d_perm'%k] = asarray(sampler.perm,dtype=int32)
+        name,keys,pos,has_gauss,cached_gaussian = rng_state
+        events['%d_rng_keys'%k] = asarray(keys,dtype=uint32)
+        events['%d_rng_pos'%k] = array(pos)
+        events['%d_rng_gauss'%k] = array([has_gauss,cached_gaussian],
+                                         dtype=float64)
+        if sampler.neighbors is not None:
+            offsets = [0]
+            for nbrs in sampler.neighbors:
+                offsets.append(offsets[-1] + len(nbrs))
+            events['%d_neighbors'%k] = array(
+                [b for nbrs in sampler.neighbors for b in nbrs],dtype=int32)
+            events['%d_neighbor_offsets'%k] = array(offsets,dtype=int32)
+        events['%d_method'%k] = array(method)
+        events['%d_nsweeps'%k] = array(nsweeps)
+        events['%d_time'%k] = array(t)
+        self.nevents += 1
+        if self.nevents >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the exchanges archived since the last flush."""
+        if self.nevents == 0:
+            return
+        if self.tolerance is None:
+            tolerance = float('nan')
+        else:
+            tolerance = self.tolerance
+        f = open('%s_swap_%05d.npz'%(self.basename,self.nchunks),'wb')
+        savez(f,tolerance=array(tolerance),exact_max=array(self.exact_max),
+              **self.events)
+        f.close()
+        self.nchunks += 1
+        self.events = {}
+        self.nevents = 0
+
+def read_swap_archive(basename):
+    """
+    Iterate over the exchanges archived for basename, as dicts with the
+    keys listed in the module documentation (without the 'k_' prefixes).
+    The rng entry is the state of the random number stream, ready for
+    RandomState.set_state(), neighbors is None without a graph and the
+    settings of the chunk, tolerance and exact_max, are None if they were
+    not set (or not archived).
+    """
+    for filename in _chunk_files(basename):
+        archive = load(filename)
+        nevents = len([name for name in archive.files
+                       if name.endswith('_replicas')])
+        tolerance = None
+        if 'tolerance' in archive.files:
+            tolerance = float(archive['tolerance'])
+            if isnan(tolerance):
+                tolerance = None
+        exact_max = None
+        if 'exact_max' in archive.files:
+            exact_max = int(archive['exact_max'])
+        for k in range(nevents):
+            event = {}
+            for key in ('replicas','states','W','perm'):
+                event[key] = archive['%d_%s'%(k,key)]
+            gauss = archive['%d_rng_gauss'%k]
+            event['rng'] = ('MT19937',archive['%d_rng_keys'%k],
+                            int(archive['%d_rng_pos'%k]),int(gauss[0]),
+                            float(gauss[1]))
+            if '%d_neighbors'%k in archive.files:
+                nbrs = archive['%d_neighbors'%k].tolist()
+                offsets = archive['%d_neighbor_offsets'%k].tolist()
+                event['neighbors'] = [nbrs[first:last] for first,last
+                                      in zip(offsets[0:-1],offsets[1:])]
+            else:
+                event['neighbors'] = None
+            event['method'] = str(archive['%d_method'%k])
+            event['nsweeps'] = int(archive['%d_nsweeps'%k])
+            event['time'] = float(archive['%d_time'%k])
+            event['tolerance'] = tolerance
+            event['exact_max'] = exact_max
+            yield event
+
+def _missing_energies(replica, states):
+    # Energies that were not archived: such swaps are never accepted.
+    return [float('nan') for sid in states]
+
+def replay_exchange(event, method='archived', nsweeps=None, tolerance=None):
+    """
+    Replay an archived exchange with a sampling method (one of
+    REPLAY_METHODS, 'archived' being the method used by the run) starting
+    from the archived random number state, and return the sampler. The
+    number of sweeps defaults to the archived one and the tolerance to the
+    archived EXCHANGE_TOLERANCE (or 0.1). Replaying the archived method
+    reproduces the archived permutation, except for exchanges done by
+    blocks (which are replayed with Metropolis sweeps) and for sweeps to
+    tolerance cut short by EXCHANGE_TIME_BUDGET. Exact draws are replaced by
+    Metropolis sweeps for more replicas than the archived
+    EXCHANGE_EXACT_MAX and on a graph of neighbor states, where only the
+    energies computed during the run are known.
+    """
+    n = len(event['replicas'])
+    rng = RandomState()
+    rng.set_state(event['rng'])
+    W = event['W']
+    sampler = ExchangeSampler(range(n),range(n),W,event['neighbors'],
+                              _missing_energies,rng)
+    # the sweeps to tolerance of the run stopped after the archived sweeps
+    max_sweeps = None
+    if method == 'archived':
+        method = event['method']
+        max_sweeps = event['nsweeps']
+    if nsweeps is None:
+        nsweeps = event['nsweeps']
+    if tolerance is None:
+        tolerance = event.get('tolerance')
+        if tolerance is None:
+            tolerance = 0.1
+    exact_max = event.get('exact_max')
+    if exact_max is None:
+        exact_max = EXACT_SAMPLING_MAX
+    if (method == 'exact' and event['neighbors'] is None and
+        n <= exact_max):
+        sampler.exact_sample()
+    elif method == 'sweep' and event['neighbors'] is None:
+        sampler.sweep(nsweeps)
+    elif method == 'tolerance':
+        sampler.sweep_to_tolerance(tolerance,max_sweeps)
+    else:
+        sampler.metropolis_sweep(nsweeps)
+    return sampler
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] BASENAME',
+                          description='Replay the archived exchanges of an '
+                          'RE job with the Gibbs samplers, without MD.')
+    parser.add_option('-m','--methods',default='archived',
+                      help='comma separated sampling methods to replay, '
+                      'among %s [default: %%default]'%', '.join(REPLAY_METHODS))
+    parser.add_option('-n','--nsweeps',type='int',default=None,
+                      help='number of sweeps [default: as archived]')
+    parser.add_option('-t','--tolerance',type='float',default=None,
+                      help='EXCHANGE_TOLERANCE of the tolerance method '
+                      '[default: as archived, or 0.1]')
+    options,args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Please specify ONE basename')
+    methods = options.methods.split(',')
+    for method in methods:
+        if method not in REPLAY_METHODS:
+            parser.error('Unknown method %s'%method)
+
+    nevents = 0
+    times = dict([(method,0.) for method in methods])
+    energies = dict([(method,0.) for method in methods])
+    same = dict([(method,0) for method in methods])
+    for event in read_swap_archive(args[0]):
+        nevents += 1
+        for method in methods:
+            start_time = time.time()
+            sampler = replay_exchange(event,method,options.nsweeps,
+                                      options.tolerance)
+            times[method] += time.time() - start_time
+            energies[method] += sampler.energy()
+            if (sampler.perm == event['perm']).all():
+                same[method] += 1
+    if nevents == 0:
+        print 'No exchanges archived for %s'%args[0]
+        sys.exit(1)
+    print 'Replayed %d exchanges of %s'%(nevents,args[0])
+    print '%-10s %12s %14s %12s'%('method','time/exch (s)','mean energy',
+                                  'as archived')
+    for method in methods:
+        print '%-10s %12.4f %14.4f %11.1f%%'%(method,times[method]/nevents,
+                                             energies[method]/nevents,
+                                             100.*same[method]/nevents)
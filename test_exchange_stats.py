@@ -0,0 +1,90 @@
+"""Tests of the online exchange statistics"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from numpy import arange, abs, allclose, asarray, fromfile, int32
+from numpy.random import RandomState
+
+from gibbs_sampling import ExchangeSampler, grid_neighbors
+from exchange_stats import ExchangeStatistics
+
+def _exchange(stats, sampler, method, nsweeps, t):
+    sampler.track_transitions()
+    if method == 'sweep':
+        sampler.sweep(nsweeps)
+    elif method == 'metropolis':
+        sampler.metropolis_sweep(nsweeps)
+    else:
+        sampler.exact_sample()
+    states = [sampler.states[a] for a in sampler.perm]
+    stats.record(sampler,states,t)
+
+class ExchangeStatisticsTest(unittest.TestCase):
+    n = 6
+
+    def setUp(self):
+        self.U = 3.*RandomState(0).random_sample((self.n,self.n))
+
+    def expected(self, method, neighbors=None, nsweeps=3000):
+        stats = ExchangeStatistics(self.n,self.n)
+        sampler = ExchangeSampler(range(self.n),range(self.n),self.U,
+                                  neighbors,rng=RandomState(1))
+        _exchange(stats,sampler,method,nsweeps,1.)
+        return stats
+
+    def test_expected_rows_are_probabilities(self):
+        for method in ('sweep','metropolis','exact'):
+            observed,expected = self.expected(method).transition_matrices()
+            self.assertTrue((expected >= -1.e-12).all())
+            self.assertTrue(allclose(expected.sum(axis=1),1.))
+            self.assertTrue(allclose(observed.sum(axis=1),1.))
+
+    def test_steps_of_visits_and_matchings_agree(self):
+        # the same transition matrix of a step, from the full rows of
+        # visit() and from the proposals of the random matchings
+        visits = self.expected('sweep').transition_matrices()[1]
+        matchings = self.expected('metropolis').transition_matrices()[1]
+        self.assertTrue(abs(visits - matchings).max() < 0.03)
+
+    def test_steps_are_accumulated(self):
+        stats = self.expected('metropolis',nsweeps=10)
+        # two matchings of n/2 pairs per sweep, two replicas per pair
+        self.assertEqual(stats.visits.sum(),10*2*self.n)
+
+    def test_graph_moves_to_neighbors_only(self):
+        neighbors = grid_neighbors([[a] for a in range(self.n)])
+        expected = self.expected('metropolis',neighbors,
+                                 nsweeps=200).transition_matrices()[1]
+        far = abs(arange(self.n)[:,None] - arange(self.n)[None,:]) > 1
+        self.assertTrue((expected[far] == 0.).all())
+        self.assertTrue(allclose(expected.sum(axis=1),1.))
+
+    def test_round_trips(self):
+        stats = ExchangeStatistics(3,2)
+        for t,states in enumerate([[0,2],[1,1],[2,0],[1,1],[0,2],[2,0]]):
+            stats._record_round_trips(asarray(states,dtype=int32),float(t))
+        counts,times = stats.round_trip_times()
+        self.assertEqual(counts.tolist(),[1,1])
+        self.assertEqual(times.tolist(),[4.,3.])
+
+    def test_flush_and_restore(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            basename = os.path.join(tmpdir,'job')
+            stats = self.expected('metropolis',nsweeps=20)
+            stats.flush(basename)
+            restored = ExchangeStatistics(self.n,self.n)
+            self.assertTrue(restored.restore(basename))
+            self.assertTrue(allclose(restored.expected,stats.expected))
+            self.assertTrue(allclose(restored.observed,stats.observed))
+            self.assertEqual(restored.exchange_times.tolist(),[1.])
+            trajectory = fromfile(basename + '.xtraj',dtype=int32)
+            self.assertEqual(len(trajectory),self.n)
+            self.assertFalse(ExchangeStatistics(3,3).restore(basename))
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
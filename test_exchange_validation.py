@@ -0,0 +1,56 @@
+"""Tests of the exchange samplers against the exact permutation distribution"""
+import unittest
+from itertools import permutations
+
+from numpy import exp, allclose, arange, where, isinf, nan
+from numpy.random import RandomState
+
+from exchange_validation import (permutation_codes, exact_log_distribution,
+                                 validate_sampler, SAMPLERS)
+
+class ExchangeValidationTest(unittest.TestCase):
+    # 5 replicas (120 permutations): the divergence of independent samples
+    # is about 119/(2*nsamples) = 0.006, that of a sampler at a temperature
+    # off by 20% about 0.015 more
+    nreplicas = 5
+    nsamples = 10000
+    # (the blocks of 2 states of the blocks sampler mix slowly)
+    bounds = {'blocks': 0.04}
+
+    def test_permutation_codes(self):
+        perms = list(permutations(range(4)))
+        self.assertEqual(permutation_codes(perms).tolist(),range(24))
+
+    def test_exact_log_distribution(self):
+        W = 2.*RandomState(0).random_sample((4,4))
+        logp = exact_log_distribution(W)
+        self.assertTrue(allclose(exp(logp).sum(),1.))
+        # identity (code 0) and reversed (code 23) permutations
+        u_identity = W[arange(4),arange(4)].sum()
+        u_reversed = W[arange(4)[::-1],arange(4)].sum()
+        self.assertTrue(allclose(logp[0] - logp[23],u_reversed - u_identity))
+
+    def test_samplers(self):
+        W = 2.*RandomState(1).random_sample((self.nreplicas,self.nreplicas))
+        for name in sorted(SAMPLERS):
+            rate,kl = validate_sampler(name,W,self.nsamples,seed=2)
+            self.assertTrue(kl < self.bounds.get(name,0.012),
+                            '%s: KL divergence %.4f'%(name,kl))
+
+    def test_samplers_with_energies_left_out(self):
+        # energies above 1.5 left out (NaN), as by BIAS_CUTOFF, and replica
+        # 1 held in its state: 18 permutations can be reached, for a
+        # divergence of independent samples of about 0.001
+        W = 2.*RandomState(3).random_sample((self.nreplicas,self.nreplicas))
+        W = where(W > 1.5,nan,W)
+        W[1,1] = nan
+        logp = exact_log_distribution(W)
+        self.assertEqual((~isinf(logp)).sum(),18)
+        # (the blocks cannot reach all of them and are not used then, nor
+        # does the pairwise sampler leave energies out)
+        for name in ('exact','metropolis','sweep'):
+            rate,kl = validate_sampler(name,W,self.nsamples,seed=4)
+            self.assertTrue(kl < 0.005,'%s: KL divergence %.4f'%(name,kl))
+
+if __name__ == '__main__':
+    unittest.main()
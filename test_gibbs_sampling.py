@@ -0,0 +1,67 @@
+"""Tests of the block sampling of exchanges (see gibbs_sampling.py)"""
+import unittest
+from multiprocessing import Pool
+
+from numpy.random import RandomState
+
+from gibbs_sampling import (ExchangeSampler, state_perm_distribution,
+                            sample_to_state_perm_distribution,
+                            state_perm_divergence)
+
+class BlockSampleTest(unittest.TestCase):
+    # 5 replicas (120 permutations): the divergence of independent samples
+    # is about 119/(2*nsamples) = 0.006
+    nreplicas = 5
+    nsamples = 10000
+
+    def setUp(self):
+        self.U = 2.*RandomState(0).random_sample((self.nreplicas,
+                                                  self.nreplicas))
+
+    def divergence(self, block_size, exact_max):
+        # the same check as running gibbs_sampling.py
+        replicas = range(self.nreplicas)
+        states = range(self.nreplicas)
+        sampler = ExchangeSampler(replicas,states,self.U,rng=RandomState(1))
+        counts = {}
+        for n in xrange(self.nsamples):
+            if block_size is None:
+                sampler.metropolis_sweep(1)
+            else:
+                sampler.block_sample(block_size,(n % 2)*(block_size/2),
+                                     exact_max=exact_max)
+            perm = str(zip(replicas,sampler.current_states()))
+            counts[perm] = counts.get(perm,0) + 1.
+        empirical = sample_to_state_perm_distribution(counts,replicas,states)
+        return state_perm_divergence(empirical,
+                                     state_perm_distribution(replicas,states,
+                                                             self.U))
+
+    def test_serial(self):
+        self.assertTrue(self.divergence(None,0) < 0.02)
+
+    def test_blocks_of_sweeps(self):
+        self.assertTrue(self.divergence(3,0) < 0.02)
+
+    def test_exact_blocks(self):
+        self.assertTrue(self.divergence(3,3) < 0.02)
+
+    def test_pool_draws_the_serial_permutation(self):
+        # each block gets its seed from the sampler, wherever it is sampled
+        U = RandomState(2).random_sample((40,40))
+        perms = []
+        pool = Pool(processes=2)
+        try:
+            for p in (None,pool):
+                sampler = ExchangeSampler(range(40),range(40),U,
+                                          rng=RandomState(3))
+                sampler.block_sample(8,4,p,nsweeps=5,exact_max=4)
+                perms.append(sampler.perm.tolist())
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(perms[0],perms[1])
+        self.assertEqual(sorted(perms[0]),range(40))
+
+if __name__ == '__main__':
+    unittest.main()
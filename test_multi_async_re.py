@@ -0,0 +1,38 @@
+"""Tests of the sharing of a pilot among several RE jobs"""
+import unittest
+
+from multi_async_re import fair_shares
+
+class FairSharesTest(unittest.TestCase):
+    def assertShares(self, shares, expected):
+        self.assertEqual(len(shares),len(expected))
+        for share,value in zip(shares,expected):
+            self.assertAlmostEqual(share,value)
+
+    def test_weighted_split(self):
+        # neither demand is met: split in proportion to the weights
+        self.assertShares(fair_shares([10,10],[1,3],8),[2.,6.])
+
+    def test_met_demand_is_redistributed(self):
+        self.assertShares(fair_shares([1,10],[1,1],8),[1.,7.])
+        self.assertShares(fair_shares([1,2,10],[1,1,1],9),[1.,2.,6.])
+
+    def test_no_demand(self):
+        self.assertShares(fair_shares([0,5],[1,1],4),[0.,4.])
+        self.assertShares(fair_shares([0,0],[1,1],4),[0.,0.])
+
+    def test_total_beyond_demands(self):
+        self.assertShares(fair_shares([2,3],[1,1],10),[2.,3.])
+
+    def test_never_more_than_total_or_demand(self):
+        demands = [3,7,1,12,5]
+        weights = [2,1,1,3,1]
+        for total in range(0,30):
+            shares = fair_shares(demands,weights,total)
+            self.assertTrue(sum(shares) <= total + 1.e-9)
+            for share,demand in zip(shares,demands):
+                self.assertTrue(0. <= share <= demand + 1.e-9)
+            self.assertAlmostEqual(sum(shares),min(total,sum(demands)))
+
+if __name__ == '__main__':
+    unittest.main()
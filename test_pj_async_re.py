@@ -0,0 +1,44 @@
+"""Tests of the random number streams of an RE job"""
+import unittest
+import pickle
+
+from pj_async_re import RandomStreams
+
+class RandomStreamsTest(unittest.TestCase):
+    def test_seeded_streams_repeat(self):
+        a = RandomStreams(7)
+        b = RandomStreams(7)
+        self.assertEqual(a.stream('exchange').randint(0,1000,10).tolist(),
+                         b.stream('exchange').randint(0,1000,10).tolist())
+
+    def test_streams_are_independent(self):
+        a = RandomStreams(7)
+        b = RandomStreams(7)
+        # drawing from another stream does not change this one
+        b.stream('launch').random_sample(100)
+        self.assertEqual(a.stream('exchange').random_sample(5).tolist(),
+                         b.stream('exchange').random_sample(5).tolist())
+        self.assertNotEqual(a.stream('launch').random_sample(5).tolist(),
+                            a.stream('exchange').random_sample(5).tolist())
+
+    def test_seeds_differ(self):
+        self.assertNotEqual(
+            RandomStreams(7).stream('exchange').random_sample(5).tolist(),
+            RandomStreams(8).stream('exchange').random_sample(5).tolist())
+
+    def test_pickle_continues_the_streams(self):
+        # as the streams saved in BASENAME.rng with the status of a job
+        for seed in (7,None):
+            rng = RandomStreams(seed)
+            rng.stream('exchange').random_sample(3)
+            rng.stream('exchange').standard_normal()
+            saved = pickle.dumps(rng)
+            expected = rng.stream('exchange').random_sample(5).tolist()
+            restored = pickle.loads(saved)
+            self.assertEqual(restored.seed,seed)
+            self.assertEqual(
+                restored.stream('exchange').random_sample(5).tolist(),
+                expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests of the swap matrix archive and of the replay of exchanges"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from numpy import isnan, nan
+from numpy.random import RandomState
+
+from gibbs_sampling import ExchangeSampler, grid_neighbors
+from swap_archive import (SwapMatrixArchive, read_swap_archive,
+                          replay_exchange, _chunk_files)
+
+class SwapArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.basename = os.path.join(self.tmpdir,'job')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def exchange(self, archive, method, n=8, seed=0, neighbors=None):
+        # an exchange of n replicas (ids 10, 11, ...) in states 20, 21, ...
+        U = 3.*RandomState(seed).random_sample((20 + n,10 + n))
+        if neighbors is not None:
+            U[20,10 + n - 1] = nan
+        rng = RandomState(seed + 100)
+        sampler = ExchangeSampler(range(10,10 + n),range(20,20 + n),U,
+                                  neighbors,lambda repl,sids: [1.]*len(sids),
+                                  rng)
+        rng_state = rng.get_state()
+        if method == 'exact':
+            sampler.exact_sample()
+            nsweeps = 0
+        elif method == 'sweep':
+            nsweeps = 3
+            sampler.sweep(nsweeps)
+        elif method == 'tolerance':
+            nsweeps,tau = sampler.sweep_to_tolerance(archive.tolerance)
+        else:
+            nsweeps = 7
+            sampler.metropolis_sweep(nsweeps)
+        archive.append(sampler,rng_state,method,nsweeps,float(seed))
+        return sampler
+
+    def test_round_trip_and_replay(self):
+        archive = SwapMatrixArchive(self.basename,chunk_size=2,tolerance=0.3,
+                                    exact_max=8)
+        samplers = [self.exchange(archive,'sweep',seed=0),
+                    self.exchange(archive,'metropolis',seed=1),
+                    self.exchange(archive,'exact',seed=2),
+                    self.exchange(archive,'tolerance',seed=3),
+                    self.exchange(archive,'metropolis',seed=4,
+                                  neighbors=grid_neighbors([[a] for a in
+                                                            range(8)]))]
+        archive.flush()
+        self.assertEqual(len(_chunk_files(self.basename)),3)
+        events = list(read_swap_archive(self.basename))
+        self.assertEqual(len(events),len(samplers))
+        for event,sampler in zip(events,samplers):
+            self.assertEqual(event['replicas'].tolist(),sampler.replicas)
+            self.assertEqual(event['states'].tolist(),sampler.states)
+            self.assertEqual(isnan(event['W']).tolist(),
+                             isnan(sampler.W).tolist())
+            self.assertEqual(event['perm'].tolist(),sampler.perm.tolist())
+            self.assertEqual(event['neighbors'],sampler.neighbors)
+            self.assertEqual(event['tolerance'],0.3)
+            self.assertEqual(event['exact_max'],8)
+            # the archived method reproduces the archived permutation
+            replayed = replay_exchange(event)
+            self.assertEqual(replayed.perm.tolist(),event['perm'].tolist())
+        self.assertEqual([event['method'] for event in events],
+                         ['sweep','metropolis','exact','tolerance',
+                          'metropolis'])
+        # (an energy never needed on the graph is archived as not computed)
+        self.assertTrue(isnan(events[4]['W'][0,7]))
+
+    def test_settings_not_set(self):
+        archive = SwapMatrixArchive(self.basename)
+        self.exchange(archive,'sweep')
+        archive.flush()
+        event = list(read_swap_archive(self.basename))[0]
+        self.assertEqual(event['tolerance'],None)
+        # other methods can be replayed from the same event
+        for method in ('exact','sweep','metropolis','tolerance'):
+            sampler = replay_exchange(event,method,nsweeps=2)
+            self.assertEqual(sorted(sampler.perm.tolist()),range(8))
+
+    def test_new_run_continues_the_chunks(self):
+        archive = SwapMatrixArchive(self.basename)
+        self.exchange(archive,'sweep')
+        archive.flush()
+        archive = SwapMatrixArchive(self.basename)
+        self.exchange(archive,'metropolis',seed=1)
+        archive.flush()
+        self.assertEqual([os.path.basename(name) for name in
+                          _chunk_files(self.basename)],
+                         ['job_swap_00000.npz','job_swap_00001.npz'])
+        self.assertEqual([event['time'] for event in
+                          read_swap_archive(self.basename)],[0.,1.])
+
+if __name__ == '__main__':
+    unittest.main()